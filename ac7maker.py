@@ -14,8 +14,20 @@ import struct
 import os
 #import operator
 import sys
+import argparse
+import hashlib
+import pickle
+import time
+import concurrent.futures
+
+# NumPy is optional. If it's there, it's used to encode long tracks faster
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 import internal.midifiles
+from internal.sourcecache import SourceCache
 
 
 # Default instrument allocations. Ordered by part number
@@ -213,23 +225,47 @@ def ac7make_mixer_element(pt, b):
   g += struct.pack('B', b['rhythm']['parts'][pt-1].get('chorus_send', 0))   # chorus send
   return(g)
 
+def ac7make_block_size(entries):
+  # Returns the size of a "MIXR", "DRUM" or "OTHR" block holding a vector of data
+  # strings: 4-byte name, 4-byte size, 2-byte count, then a 4-byte address for each
+  # entry followed by the entries themselves
+  
+  return 10 + 4*len(entries) + sum(len(ee) for ee in entries)
+
+def ac7make_write_block(buf, pos, name, entries, addr):
+  # Write a "MIXR", "DRUM" or "OTHR" block into a bytearray (or memoryview) "buf" at
+  # position "pos". "addr" is the address of the block in the AC7 file, from
+  # which the entry addresses are worked out. Returns the position after the
+  # block.
+  
+  number_of_parts = len(entries)
+  buf[pos:pos+4] = name
+  struct.pack_into('<IH', buf, pos+4, ac7make_block_size(entries), number_of_parts)
+  p = pos + 10
+  addr = addr + 10 + 4*number_of_parts
+  for ee in entries:
+    struct.pack_into('<I', buf, p, addr)
+    p += 4
+    addr += len(ee)
+  for ee in entries:
+    buf[p:p+len(ee)] = ee
+    p += len(ee)
+  return p
+
+def ac7make_block(name, entries, addr):
+  # Make a "MIXR", "DRUM" or "OTHR" block on its own
+  
+  g = bytearray(ac7make_block_size(entries))
+  ac7make_write_block(g, 0, name, entries, addr)
+  return bytes(g)
+
 def ac7make_mixer(mixers, addr):
   # Make a "MIXR" block from a vector of data strings
   
-  g1 = b'MIXR'
-  g2 = b''
-  g3 = b''
   number_of_parts = len(mixers)
   if number_of_parts != 96:
     raise Exception("Expected 96 mixer parts, got {0}".format(number_of_parts))
-  addr = addr + 10 + 4*number_of_parts
-  for mm in mixers:
-    g3 = g3 + mm
-    g2 = g2 + struct.pack('<I', addr)
-    addr = addr + len(mm)
-  g1 = g1 + struct.pack('<I', 10 + len(g2) + len(g3))
-  g1 = g1 + struct.pack('<H', number_of_parts)
-  return (g1 + g2 + g3)
+  return ac7make_block(b'MIXR', mixers, addr)
 
 # Determine if the element should be omitted in total from the rhythm. Typically
 # this is done for elements 7, 8, 9 & 10 and is possibly for compatibility
@@ -242,74 +278,148 @@ def ac7make_element_has_other(b, el):
 
 
 
+# Tracks with fewer events than this are always encoded one event at a time, as
+# setting up the NumPy arrays would take longer
+NUMPY_MIN_EVENTS = 64
+
 def ac7make_midi_to_ac7(trk, end_time):
   # Change the digested midi data into AC7 track data
+  
+  if numpy is not None and len(trk) >= NUMPY_MIN_EVENTS:
+    g = ac7make_midi_to_ac7_numpy(trk, end_time)
+    if g is not None:
+      return g
+  return ac7make_midi_to_ac7_scalar(trk, end_time)
+
+def ac7make_midi_to_ac7_scalar(trk, end_time):
+  # Change the digested midi data into AC7 track data, one event at a time.
+  # Event times are whole AC7 ticks already (see internal.midifiles), so no
+  # rounding is needed here
+  NOTE_ON = internal.midifiles.NOTE_ON
+  NOTE_OFF = internal.midifiles.NOTE_OFF
   latest_time = 0
-  b = b''
+  b = bytearray()
   for evt in trk:
-    if evt['event'] == 'note_on':
-      v = evt['velocity']
+    if evt.type == NOTE_ON:
+      v = evt.data2
       if v == 0:
         v = 1  # AC7 doesn't allow on velocity of 0
-      time_d = round(4.0*(evt['absolute_time'] - latest_time))
+      time_d = evt.time - latest_time
       if time_d > 255:
         b += ac7make_time_jump(time_d)
         time_d = 0
-      b += struct.pack('<3B', time_d, evt['note'], v)
-      latest_time = evt['absolute_time']
-    elif evt['event'] == 'note_off':
-      time_d = round(4.0*(evt['absolute_time'] - latest_time))
+      b += struct.pack('<3B', time_d, evt.data1, v)
+      latest_time = evt.time
+    elif evt.type == NOTE_OFF:
+      time_d = evt.time - latest_time
       if time_d > 255:
         b += ac7make_time_jump(time_d)
         time_d = 0
-      b += struct.pack('<3B', time_d, evt['note'], 0x00)
-      latest_time = evt['absolute_time']
+      b += struct.pack('<3B', time_d, evt.data1, 0x00)
+      latest_time = evt.time
     else:
       d = ac7make_track_event(evt)
       if len(d)==2:
-        time_d = round(4.0*(evt['absolute_time'] - latest_time))
+        time_d = evt.time - latest_time
         if time_d > 255:
           b += ac7make_time_jump(time_d)
           b += b'\x00' + d
         else:
           b += struct.pack('<B', time_d) + d
-        latest_time = evt['absolute_time']
+        latest_time = evt.time
       
-  time_d = end_time - round(4.0*latest_time)
+  time_d = end_time - latest_time
   if time_d > 255:
     b += ac7make_time_jump(time_d)
     time_d = 0
   b += struct.pack('<3B', time_d, 0xFC, 0x00) # End-of-track indicator
-  return b
-
-def ac7make_get_track(tracks, ch):
+  return bytes(b)
+
+def ac7make_midi_to_ac7_numpy(trk, end_time):
+  # Change the digested midi data into AC7 track data, the same as
+  # ac7make_midi_to_ac7_scalar() but working on arrays of all the events at once.
+  # Returns None if the track can't be encoded this way (times going backwards, or
+  # jumps too long for a single time-jump event); the scalar version will then
+  # give the appropriate error.
+  
+  # Collect the events which produce AC7 events: time, and the two data bytes
+  NOTE_ON = internal.midifiles.NOTE_ON
+  NOTE_OFF = internal.midifiles.NOTE_OFF
+  times = []
+  data_1 = []
+  data_2 = []
+  for evt in trk:
+    e = evt.type
+    if e == NOTE_ON:
+      times.append(evt.time)
+      data_1.append(evt.data1)
+      data_2.append(evt.data2 or 1)  # AC7 doesn't allow on velocity of 0
+    elif e == NOTE_OFF:
+      times.append(evt.time)
+      data_1.append(evt.data1)
+      data_2.append(0x00)
+    else:
+      d = ac7make_track_event(evt)
+      if len(d)==2:
+        times.append(evt.time)
+        data_1.append(d[0])
+        data_2.append(d[1])
+  n = len(times)
+  t = numpy.array([0] + times, dtype=numpy.int64)
+  
+  # Time differences in AC7 ticks
+  time_d = numpy.diff(t)
+  end_d = end_time - int(t[-1])
+  if n > 0 and (time_d.min() < 0 or time_d.max() > 0xFFFF):
+    return None
+  if end_d < 0 or end_d > 0xFFFF:
+    return None
+  
+  # Any difference over 255 needs a time-jump event before the event itself,
+  # which then has a difference of 0
+  jump = time_d > 255
+  pos = numpy.arange(n) + numpy.cumsum(jump)
+  g = numpy.zeros((n + int(jump.sum()) + 1 + int(end_d > 255), 3), dtype=numpy.uint8)
+  g[pos, 0] = numpy.where(jump, 0, time_d)
+  g[pos, 1] = numpy.array(data_1, dtype=numpy.uint8)
+  g[pos, 2] = numpy.array(data_2, dtype=numpy.uint8)
+  g[pos[jump] - 1] = numpy.stack((time_d[jump]%256, numpy.full(int(jump.sum()), 0xFF), time_d[jump]//256), axis=1)
+  
+  # End-of-track indicator
+  if end_d > 255:
+    g[-2] = (end_d%256, 0xFF, end_d//256)
+    end_d = 0
+  g[-1] = (end_d, 0xFC, 0x00)
+  return g.tobytes()
+
+def ac7make_get_track(tracks, ch, index=None):
   # Select a track from an array of tracks by matching the MIDI channel number.
-  # This is appropriate for Type I MIDI files where each MIDI channel has its
-  # own track. It's not explicitly checked that the MIDI is structured in that
-  # way, if not then behaviour will be undefined.
+  # For Type I MIDI files, where each MIDI channel has its own track, this is the
+  # first track with notes on that channel. Only the events of channel "ch" are
+  # returned, along with the events that have no channel, so other channels in
+  # the same track (e.g. a Type 0 MIDI file) are left out.
+  #
+  # "index" is an optional internal.midifiles.ChannelIndex of the tracks. If given,
+  # the track is looked up there instead of searching through the tracks.
   #
   
-  for trk in tracks:
-    for evt in trk:
-      if evt['event']=='note_on' and evt['channel']==ch:
-        # Have found the track!
-        return trk
-  # If get here, have not found any track
-  return None
+  if index is None:
+    index = internal.midifiles.ChannelIndex(tracks)
+  return index.events_for(tracks, ch)
 
-def ac7make_drum_element(pt, el, total_midi_clks, midi_trks, trk_ch = -1):
+def ac7make_drum_element(pt, el, total_ticks, midi_trks, trk_ch = -1, midi_index=None):
   # Create a single track to go into the "DRUM" section of the AC7 file
   #
   
   g1 = b''
   if midi_trks != None:
-    midi_trk = ac7make_get_track(midi_trks, trk_ch)
+    midi_trk = ac7make_get_track(midi_trks, trk_ch, midi_index)
   else:
     midi_trk = None
   if midi_trk != None:  
     g1 += b'\x00\xe5\x00'  # Optional. This makes the track editable, probably a good thing..
-    # Translate total time from midi clocks (24 per crotchet) to AC7 clocks (96 per crotchet)
-    g1 += ac7make_midi_to_ac7(midi_trk, round(4.0*total_midi_clks))
+    # Total time is already in AC7 clocks (96 per crotchet)
+    g1 += ac7make_midi_to_ac7(midi_trk, total_ticks)
   else:
     # A default value that means "skip to track end time" (a skip of 0x0480 is for some reason
     # interpreted in that way) followed by "end of track".
@@ -321,19 +431,7 @@ def ac7make_drum(drums, start_addr):
   # Create the "DRUM" section from an array of drum tracks
   #
   
-  g1 = b'DRUM'
-  g2 = b''
-  g3 = b''
-  
-  number_of_parts = len(drums)
-  addr = start_addr + 10 + 4*number_of_parts
-  for dd in drums:
-    g2 += struct.pack('<I', addr)
-    addr += len(dd)
-    g3 += dd
-  g1 += struct.pack('<I', 10 + len(g2) + len(g3))
-  g1 += struct.pack('<H', number_of_parts)
-  return (g1 + g2 + g3)
+  return ac7make_block(b'DRUM', drums, start_addr)
 
 
 def ac7make_chord_conversion(tk):
@@ -500,7 +598,7 @@ def ac7make_track_event(e):
   return b''
 
 
-def ac7make_other_element(pt, el, trk, total_midi_clks, midi_trks, trk_ch=-1):
+def ac7make_other_element(pt, el, trk, total_ticks, midi_trks, trk_ch=-1, midi_index=None):
   # Create a Casio-style track for Other (i.e. non-Drum). That will start with a
   # 3-byte "starter" followed by track events
   #
@@ -510,13 +608,13 @@ def ac7make_other_element(pt, el, trk, total_midi_clks, midi_trks, trk_ch=-1):
   else:
     g1 = ac7make_starter({"part": pt, "element": el})
   if midi_trks != None:
-    midi_trk = ac7make_get_track(midi_trks, trk_ch)
+    midi_trk = ac7make_get_track(midi_trks, trk_ch, midi_index)
   else:
     midi_trk = None
   if midi_trk != None:
     g1 += b'\x00\xe5\x00'  # Optional. This makes the track editable, probably a good thing..
-    # Translate total time from midi clocks (24 per crotchet) to AC7 clocks (96 per crotchet)
-    g1 += ac7make_midi_to_ac7(midi_trk, round(4.0*total_midi_clks))
+    # Total time is already in AC7 clocks (96 per crotchet)
+    g1 += ac7make_midi_to_ac7(midi_trk, total_ticks)
   else:
     g1 += b'\x80\xff\x04\x00\xfc\x00'
   return g1
@@ -526,19 +624,7 @@ def ac7make_other(others, start_addr):
   # Make an "OTHR" block given a vector of data strings
   #
   
-  g1 = b'OTHR'
-  g2 = b''
-  g3 = b''
-  
-  number_of_parts = len(others)
-  addr = start_addr + 10 + 4*number_of_parts
-  for oo in others:
-    g3 = g3 + oo
-    g2 = g2 + struct.pack('<I', addr)
-    addr = addr + len(oo)
-  g1 = g1 + struct.pack('<I', 10 + len(g2) + len(g3))
-  g1 = g1 + struct.pack('<H', number_of_parts)
-  return (g1 + g2 + g3)
+  return ac7make_block(b'OTHR', others, start_addr)
 
 
 def ac7make_element_atom(in_val, in_str):
@@ -570,18 +656,12 @@ def ac7make_time_signature(s):
   return x + 8*num
 
 
-def ac7make_element(b, elements, start_addr):
-  # Take a vector of "ELMT" block and combine them as they will be in the AC7 file
+def ac7make_element_header(b):
+  # Make the rhythm-wide data (name, time signature, tempo, effects etc.) that
+  # comes between the element addresses and the elements themselves in the
+  # "elements" block
   
-  number_of_parts = len(elements)
-  if number_of_parts != 12:
-    raise Exception("Expected 12 elements, got {0}".format(number_of_parts))
-  addr = start_addr + 7 + 4*number_of_parts
-  
-  # Magic number for "elements"
-  g0 = struct.pack('<I', 0x07ffffff)
-  
-  g2 = b''
+  g2 = bytearray()
   g2 += b'\x00\x0c'   # Name length (12 bytes)
   # Ensure the name is exactly 8 bytes long, with the final character
   # being a space.
@@ -636,20 +716,50 @@ def ac7make_element(b, elements, start_addr):
     g2 += ac7make_element_atom(17, b'\x0B\x31') # Element 12 (Ending 2?)
 
   g2 += ac7make_element_atom(255, b'') # End
+  return bytes(g2)
 
-  addr = addr + len(g2)
-
-  # Now add the individual element definitions
+def ac7make_element_block_size(g2, elements):
+  # Returns the size of the "elements" block: 4-byte magic number, 2-byte size,
+  # 1-byte count, a 4-byte address for each element, the rhythm-wide data, then
+  # each element with a 6-byte "ELMT" header
+  
+  return 7 + 4*len(elements) + len(g2) + sum(6 + len(ee) for ee in elements)
 
-  g1 = b''
-  g3 = b''
+def ac7make_write_element_block(buf, pos, g2, elements, start_addr):
+  # Write the "elements" block into a bytearray (or memoryview) "buf" at position
+  # "pos". "g2" is the rhythm-wide data from ac7make_element_header(). Returns the
+  # position after the block.
+  
+  number_of_parts = len(elements)
+  if number_of_parts != 12:
+    raise Exception("Expected 12 elements, got {0}".format(number_of_parts))
+  
+  # Magic number for "elements"
+  struct.pack_into('<IHB', buf, pos, 0x07ffffff, ac7make_element_block_size(g2, elements), number_of_parts)
+  p = pos + 7
+  addr = start_addr + 7 + 4*number_of_parts + len(g2)
   for ee in elements:
-    g3 += b'ELMT' + struct.pack('<H', 6 + len(ee)) + ee
-    g1 += struct.pack('<I', addr)
+    struct.pack_into('<I', buf, p, addr)
+    p += 4
     addr = addr + 6 + len(ee)
-  g0 += struct.pack('<H', 7 + len(g1) + len(g2) + len(g3))
-  g0 += struct.pack('B', number_of_parts)
-  return (g0 + g1 + g2 + g3)
+  buf[p:p+len(g2)] = g2
+  p += len(g2)
+  
+  # Now add the individual element definitions
+  for ee in elements:
+    buf[p:p+4] = b'ELMT'
+    struct.pack_into('<H', buf, p+4, 6 + len(ee))
+    buf[p+6:p+6+len(ee)] = ee
+    p += 6 + len(ee)
+  return p
+
+def ac7make_element(b, elements, start_addr):
+  # Take a vector of "ELMT" block and combine them as they will be in the AC7 file
+  
+  g2 = ac7make_element_header(b)
+  g = bytearray(ac7make_element_block_size(g2, elements))
+  ac7make_write_element_block(g, 0, g2, elements, start_addr)
+  return bytes(g)
 
 
 def ac7make_is_drum_part(pt):
@@ -668,6 +778,39 @@ def ac7make_dsp_effect_parameter_count(ef):
     return x
   return 13
 
+def ac7make_dsp_chain(tn):
+  # Read the DSP chain from the contents of a tone (.TON) file. Returns a list of
+  # (position in chain, effect number, bytestring of parameters) for each effect
+  
+  chain = []
+  if len(tn) >= 456:
+    for j in range(4):  # Number of effects to include
+      dsp_ef = tn[0x156 + j*0x12]
+      if dsp_ef != 0 and dsp_ef <= 0x1f:
+        p = 0x156 + j*0x12 + 2
+        chain.append((j, dsp_ef, bytes(tn[p:p+ac7make_dsp_effect_parameter_count(dsp_ef)])))
+  return chain
+
+def ac7make_dsp_atoms(chain, pn):
+  # Make the 0x36 atoms which set up a DSP chain (as returned by
+  # ac7make_dsp_chain) for part number "pn"
+  
+  g = bytearray()
+  for (j, dsp_ef, params) in chain:
+    # First define the DSP effect
+    g += ac7make_element_atom(0x36, struct.pack('<4B', 0, pn - 1 + 8, j, dsp_ef))
+    # Now add all the parameters
+    for i in range(len(params)):
+      g += ac7make_element_atom(0x36, struct.pack('<6B', 1, pn - 1 + 8, j, dsp_ef, i, params[i]))
+  return bytes(g)
+
+def ac7make_dsp_chain_atoms(tn):
+  # Make the 0x36 atoms for the DSP chain of a tone file, for each of the 8 parts
+  # in turn. Returns a list of 8 bytestrings
+  
+  chain = ac7make_dsp_chain(tn)
+  return [ac7make_dsp_atoms(chain, pn) for pn in range(1,9)]
+
 def ac7make_track_element(pt):
   # Returns the track number nibble (bottom 4 bits of the track byte)
   #
@@ -702,200 +845,454 @@ def ac7make_track_flag(trk):
       flag |= 0x10
   return flag
 
-def ac7maker(b):
-  # The main routine. Create the different parts of the AC7 file (header, ELMT,
-  # MIXR, DRUM, OTHER) and return them concatenated together.
+# Version of the incremental build manifest. Change this whenever the encoding of
+# elements or tracks changes, so that old manifests are not re-used.
+MANIFEST_VERSION = 4
+
+
+def ac7make_hash(*x):
+  # Returns a hash (hex string) of some JSON-compatible values. Keys are sorted so
+  # that the result doesn't depend on the order of the input file.
+  
+  return hashlib.sha1(json.dumps(x, sort_keys=True).encode('utf-8')).hexdigest()
+
+def ac7make_source_path(b, f):
+  # Returns the path of a source file named in the JSON definition
+  
+  return os.path.join(b.get("input_dir", ""), f)
+
+# The kinds of MIDI event which are needed to make AC7 tracks. Anything else is
+# skipped when the MIDI files are parsed.
+AC7_MIDI_KINDS = {
+  internal.midifiles.NOTE_ON,
+  internal.midifiles.NOTE_OFF,
+  internal.midifiles.CONTROL_CHANGE,
+  internal.midifiles.REGISTERED_PARAM,
+  internal.midifiles.PITCH_BEND,
+  internal.midifiles.TEMPO_CHANGE,
+  internal.midifiles.TIME_SIGNATURE,
+  internal.midifiles.TRACK_END
+}
+
+def ac7make_source_channels(b):
+  # Returns a dictionary of the MIDI channels used from each source file, so that
+  # each file is parsed only once and only for those channels. Each track only
+  # takes the events of its own channel (see ac7make_get_track()), so what else
+  # is parsed along with it makes no difference to it.
+  
+  chs = {}
+  for trk in b["rhythm"]["tracks"]:
+    chs.setdefault(ac7make_source_path(b, trk["source_file"]), set()).add(trk["source_channel"])
+  return chs
+
+def ac7make_element_hash(b, el, cache):
+  # Returns a hash of everything that the encoding of element "el" depends on: the
+  # JSON definitions of its tracks, the parts and the element itself, and the
+  # contents of all the files that these refer to.
+  
+  tracks = [trk for trk in b["rhythm"]["tracks"] if trk.get("element", -1)==el]
+  files = [cache.file_hash(ac7make_source_path(b, trk["source_file"])) for trk in tracks]
+  for pp in b["rhythm"]["parts"]:
+    if pp.get("dsp", None) != None and pp["dsp"].get("tone_file", "") != "":
+      files.append(cache.file_hash(ac7make_source_path(b, pp["dsp"]["tone_file"])))
+  return ac7make_hash(el, tracks, b["rhythm"]["parts"], b["rhythm"]["elements"][el-1], files)
+
+def ac7make_element_length(b, el, cache):
+  # First pass: find a time signature and length (in AC7 clocks, 96 per crotchet)
+  # for the element
+  
+  max_time = 0
+  time_sig = {"numerator": 0, "log_denominator": 0}
+  for trk in b["rhythm"]["tracks"]:
+    if trk.get("element", -1)==el:
+      # Only the length and time signature of each file are needed here
+      (t, ts) = cache.midi_summary(ac7make_source_path(b, trk["source_file"]))
+      if t > max_time:
+        max_time = t
+      if time_sig["numerator"] == 0 and ts is not None:
+        time_sig["numerator"] = ts[0]
+        time_sig["log_denominator"] = ts[1]
+  if max_time == 0:  # (if not, probably have no tracks associated)
+    # Use some default values
+    max_time = 96*4
+    time_sig["numerator"] = 4
+    time_sig["log_denominator"] = 2
+  else:
+    if time_sig["numerator"] == 0 or time_sig["log_denominator"] == 0:
+      raise Exception("Time signature not detected in non-empty element {0}. Make sure that a MIDI file associated with this element contains a time signature specifier".format(el))
+  return (max_time, time_sig)
+
+def ac7make_encode_element(b, el, cache, old_tracks=None):
+  # Encode a single element, together with the DRUM, OTHR & MIXR entries that belong
+  # to it. The result is a dictionary:
+  #
+  #   'element'   The element bytestring. The DRUM, OTHR & MIXR entries are numbered
+  #               from 0 within this element; see ac7make_link_element()
+  #   'fixups'    List of (offset, kind) for each entry number in 'element'. "kind" is
+  #               one of 'drums', 'others' or 'mixers'
+  #   'drums', 'others', 'mixers'
+  #               The entries themselves
+  #   'tracks'    Dictionary of encoded DRUM/OTHR entries keyed by a hash of their
+  #               inputs
+  #
+  # "old_tracks" is a 'tracks' dictionary from a previous build. Entries are taken from
+  # there instead of being encoded again if their inputs haven't changed.
+  
+  if old_tracks is None:
+    old_tracks = {}
+  (max_time, time_sig) = ac7make_element_length(b, el, cache)
+  chs = ac7make_source_channels(b)
   
-  elements = []
   mixers = []
   drums = []
   others = []
+  tracks = {}
   
-  for el in range(1,13):
-    # First pass: find a time signature, tempo and measure count for the element
-    tempo = 120
-    max_absolute_time = 0
-    time_sig = {"numerator": 0, "log_denominator": 0}
+  # Second pass: change requested tracks to Casio format (from MIDI)
+  num_trk_el = 0
+  e_20 = bytearray()
+  e_20_kinds = []
+  e_21 = bytearray()
+  e_21_kinds = []
+  e_22 = bytearray()
+  for pt in range(1,9):
+    num_trk = 0
     for trk in b["rhythm"]["tracks"]:
-      if trk.get("element", -1)==el:
-        with open(os.path.join(b.get("input_dir", ""), trk["source_file"]), "rb") as f3:
-          mdata = internal.midifiles.midifile_read(f3.read())
-        for mtrk in mdata:
-          for evt in mtrk:
-            if evt["absolute_time"] > max_absolute_time:
-              max_absolute_time = evt["absolute_time"]
-            
-            if time_sig["numerator"] == 0 and evt["event"] == "time_signature":
-              time_sig["numerator"] = evt["numerator"]
-              time_sig["log_denominator"] = evt["log_denominator"]
-    if max_absolute_time == 0:  # (if not, probably have no tracks associated)
-      # Use some default values
-      max_absolute_time = 24.0*4.0
-      time_sig["numerator"] = 4
-      time_sig["log_denominator"] = 2
-    else:
-      if time_sig["numerator"] == 0 or time_sig["log_denominator"] == 0:
-        raise Exception("Time signature not detected in non-empty element {0}. Make sure that a MIDI file associated with this element contains a time signature specifier".format(el))
-
-    # Second pass: change requested tracks to Casio format (from MIDI)
-    num_trk_el = 0
-    e_20 = b''
-    e_21 = b''
-    e_22 = b''
-    for pt in range(1,9):
-      num_trk = 0
-      for trk in b["rhythm"]["tracks"]:
-        if trk.get("element", -1)==el and trk.get("part", -1)==pt:
-          with open(os.path.join(b.get("input_dir", ""), trk["source_file"]), "rb") as f3:
-            mdata = internal.midifiles.midifile_read(f3.read())
-          
-          # Found a non-empty track to add. Add it
-          e_22 += struct.pack('<B', ac7make_track_element(pt) + ac7make_track_flag(trk))
-    
-          if ac7make_is_drum_part(pt):
-            e_20 += struct.pack('<H', len(drums) + 0x8000)
-            drums.append(ac7make_drum_element(pt, el, max_absolute_time, mdata, trk["source_channel"]))
-          else:
-            e_20 += struct.pack('<H', len(others) + 0x8000)
-            others.append(ac7make_other_element(pt, el, trk, max_absolute_time, mdata, trk["source_channel"]))
-          
-          if num_trk == 0:
-            # This is the first track for this element/part combo
-            e_21 += struct.pack('<H', len(mixers) + 0x8000)
-            mixers.append(ac7make_mixer_element(pt, b))
-          else:
-            # There's already a mixer for this combo. Just add a filler value
-            e_21 += struct.pack('<H', 0xFFFF)
-
-          num_trk += 1
-      if num_trk == 0:
-        # No tracks for this element/part combination. Add an empty one
-        e_22 += struct.pack('<B', ac7make_track_element(pt))
+      if trk.get("element", -1)==el and trk.get("part", -1)==pt:
+        src = ac7make_source_path(b, trk["source_file"])
+        h = ac7make_hash(pt, el, trk, max_time, cache.file_hash(src))
+        
+        # Found a non-empty track to add. Add it
+        e_22 += struct.pack('<B', ac7make_track_element(pt) + ac7make_track_flag(trk))
   
         if ac7make_is_drum_part(pt):
           e_20 += struct.pack('<H', len(drums) + 0x8000)
-          drums.append(ac7make_drum_element(pt, el, max_absolute_time, None))
+          e_20_kinds.append('drums')
+          g = old_tracks.get(h, None)
+          if g is None:
+            g = ac7make_drum_element(pt, el, max_time, cache.midi(src, chs[src], AC7_MIDI_KINDS), trk["source_channel"], cache.midi_index(src, chs[src], AC7_MIDI_KINDS))
+          drums.append(g)
         else:
           e_20 += struct.pack('<H', len(others) + 0x8000)
-          others.append(ac7make_other_element(pt, el, None, max_absolute_time, None))
-          
-        e_21 += struct.pack('<H', len(mixers) + 0x8000)
-        mixers.append(ac7make_mixer_element(pt, b))
+          e_20_kinds.append('others')
+          g = old_tracks.get(h, None)
+          if g is None:
+            g = ac7make_other_element(pt, el, trk, max_time, cache.midi(src, chs[src], AC7_MIDI_KINDS), trk["source_channel"], cache.midi_index(src, chs[src], AC7_MIDI_KINDS))
+          others.append(g)
+        tracks[h] = g
         
+        if num_trk == 0:
+          # This is the first track for this element/part combo
+          e_21 += struct.pack('<H', len(mixers) + 0x8000)
+          e_21_kinds.append('mixers')
+          mixers.append(ac7make_mixer_element(pt, b))
+        else:
+          # There's already a mixer for this combo. Just add a filler value
+          e_21 += struct.pack('<H', 0xFFFF)
+          e_21_kinds.append(None)
+
         num_trk += 1
+    if num_trk == 0:
+      # No tracks for this element/part combination. Add an empty one
+      e_22 += struct.pack('<B', ac7make_track_element(pt))
+
+      if ac7make_is_drum_part(pt):
+        e_20 += struct.pack('<H', len(drums) + 0x8000)
+        e_20_kinds.append('drums')
+        drums.append(ac7make_drum_element(pt, el, max_time, None))
+      else:
+        e_20 += struct.pack('<H', len(others) + 0x8000)
+        e_20_kinds.append('others')
+        others.append(ac7make_other_element(pt, el, None, max_time, None))
         
-      num_trk_el += num_trk
-    # Have now processed all the parts & tracks for this element. Complete
-    # the element bytestring
-    el_00 = b''
-    el_00 += ac7make_element_atom(1, struct.pack('<B', (time_sig["numerator"] << 3) | time_sig["log_denominator"])) # Time signature
-    num_measures = 1
-    if time_sig["log_denominator"] == 2:  # crotchet time
-      num_measures = round( max_absolute_time / (24.0*float(time_sig["numerator"] )))
-    elif time_sig["log_denominator"] == 3:  # quaver time
-      num_measures = round( max_absolute_time / (12.0*float(time_sig["numerator"] )))
-    else:
-      raise Exception("Invalid time signature in element {0}: specified {1}/2^{2}, should be 2/4 to 4/4 or 2/8 to 16/8 only".format(el, time_sig["numerator"], time_sig["log_denominator"]))
-    el_00 += ac7make_element_atom(6, struct.pack('<B', num_measures))  # Number of measures
-    el_00 += ac7make_element_atom(7, struct.pack('<B', num_trk_el))  # Total number of tracks
-    el_00 += ac7make_element_atom(0x20, e_20)
-    el_00 += ac7make_element_atom(0x21, e_21)
-    el_00 += ac7make_element_atom(0x22, e_22)
-    el_00 += ac7make_element_atom(0x30, ac7make_delay_send_vector(el, b))  # Delay send values
-    el_00 += ac7make_element_atom(253, b'')  # Start of AiX-specific data
-    # Add any 36 atoms (DSP)
-    for pp in b["rhythm"]["parts"]:
-      pn = pp["part"]
-      if pp.get("dsp", None) != None:
-        # First add a "clear DSP chain" instruction
-        el_00 += ac7make_element_atom(0x36, struct.pack('<4B', 0, pn - 1 + 8, 0, 0))
-        tf = pp["dsp"].get("tone_file", "")
-        if tf != "":
-          tn = b''
-          with open(os.path.join(b.get("input_dir", ""), tf), "rb") as f11:
-            tn = f11.read()
-          if len(tn) >= 456:
-            for j in range(4):  # Number of effects to include
-              dsp_ef = tn[0x156 + j*0x12]
-              if dsp_ef != 0 and dsp_ef <= 0x1f:
-                # Next define the DSP effect
-                el_00 += ac7make_element_atom(0x36, struct.pack('<4B', 0, pn - 1 + 8, j, dsp_ef))
-                # Now add all the param eters
-                for i in range(ac7make_dsp_effect_parameter_count(dsp_ef)):
-                  el_00 += ac7make_element_atom(0x36, struct.pack('<6B', 1, pn - 1 + 8, j, dsp_ef, i, tn[0x156 + j*0x12 + 2 +i]))
-    el_00 += ac7make_element_atom(254, b'')  # Start of CTX-specific data
-    # Add "3x"-style atoms. This is very rudimentary so far, and only allows one "33" and one "35" atom per
-    # element.
-    # Add any 33 atoms
-    h = b["rhythm"]["elements"][el-1].get("var_33", [])
-    if len(h) == 7:
-      el_00 += ac7make_element_atom(0x33, struct.pack('<7B', h[0], h[1], h[2], h[3], h[4], h[5], h[6]))  # ?? What does this do?
-    # Add any 35 atoms
-    h = b["rhythm"]["elements"][el-1].get("var_35", [])
-    if len(h) == 6:
-      el_00 += ac7make_element_atom(0x35, struct.pack('<6B', h[0], h[1], h[2], h[3], h[4], h[5]))  # Tone control parameters
-    el_00 += ac7make_element_atom(255, b'')  # End
-    elements.append(el_00)
-
+      e_21 += struct.pack('<H', len(mixers) + 0x8000)
+      e_21_kinds.append('mixers')
+      mixers.append(ac7make_mixer_element(pt, b))
+      
+      num_trk += 1
+      
+    num_trk_el += num_trk
+  # Have now processed all the parts & tracks for this element. Complete
+  # the element bytestring
+  el_00 = bytearray()
+  el_00 += ac7make_element_atom(1, struct.pack('<B', (time_sig["numerator"] << 3) | time_sig["log_denominator"])) # Time signature
+  num_measures = 1
+  if time_sig["log_denominator"] == 2:  # crotchet time
+    num_measures = round( max_time / (96.0*float(time_sig["numerator"] )))
+  elif time_sig["log_denominator"] == 3:  # quaver time
+    num_measures = round( max_time / (48.0*float(time_sig["numerator"] )))
+  else:
+    raise Exception("Invalid time signature in element {0}: specified {1}/2^{2}, should be 2/4 to 4/4 or 2/8 to 16/8 only".format(el, time_sig["numerator"], time_sig["log_denominator"]))
+  el_00 += ac7make_element_atom(6, struct.pack('<B', num_measures))  # Number of measures
+  el_00 += ac7make_element_atom(7, struct.pack('<B', num_trk_el))  # Total number of tracks
+  # Note where the entry numbers are, so that they can be offset later. Each atom has
+  # a 2-byte type & length before its data
+  fixups = []
+  for (i, k) in enumerate(e_20_kinds):
+    fixups.append((len(el_00) + 2 + 2*i, k))
+  el_00 += ac7make_element_atom(0x20, e_20)
+  for (i, k) in enumerate(e_21_kinds):
+    if k is not None:
+      fixups.append((len(el_00) + 2 + 2*i, k))
+  el_00 += ac7make_element_atom(0x21, e_21)
+  el_00 += ac7make_element_atom(0x22, e_22)
+  el_00 += ac7make_element_atom(0x30, ac7make_delay_send_vector(el, b))  # Delay send values
+  el_00 += ac7make_element_atom(253, b'')  # Start of AiX-specific data
+  # Add any 36 atoms (DSP)
+  for pp in b["rhythm"]["parts"]:
+    pn = pp["part"]
+    if pp.get("dsp", None) != None:
+      # First add a "clear DSP chain" instruction
+      el_00 += ac7make_element_atom(0x36, struct.pack('<4B', 0, pn - 1 + 8, 0, 0))
+      tf = pp["dsp"].get("tone_file", "")
+      if tf != "":
+        # The atoms are worked out once per tone file
+        el_00 += cache.parsed(ac7make_source_path(b, tf), ac7make_dsp_chain_atoms)[pn - 1]
+  el_00 += ac7make_element_atom(254, b'')  # Start of CTX-specific data
+  # Add "3x"-style atoms. This is very rudimentary so far, and only allows one "33" and one "35" atom per
+  # element.
+  # Add any 33 atoms
+  h = b["rhythm"]["elements"][el-1].get("var_33", [])
+  if len(h) == 7:
+    el_00 += ac7make_element_atom(0x33, struct.pack('<7B', h[0], h[1], h[2], h[3], h[4], h[5], h[6]))  # ?? What does this do?
+  # Add any 35 atoms
+  h = b["rhythm"]["elements"][el-1].get("var_35", [])
+  if len(h) == 6:
+    el_00 += ac7make_element_atom(0x35, struct.pack('<6B', h[0], h[1], h[2], h[3], h[4], h[5]))  # Tone control parameters
+  el_00 += ac7make_element_atom(255, b'')  # End
+  
+  return {'element': bytes(el_00), 'fixups': fixups, 'drums': drums, 'others': others, 'mixers': mixers, 'tracks': tracks}
 
+def ac7make_link_element(enc, bases):
+  # Returns the element bytestring from an encoded element (as returned by
+  # ac7make_encode_element), with its DRUM, OTHR & MIXR entry numbers offset by the
+  # number of entries in the elements before it. "bases" is a dictionary of those
+  # offsets with keys 'drums', 'others' & 'mixers'.
+  
+  g = bytearray(enc['element'])
+  for (off, kind) in enc['fixups']:
+    struct.pack_into('<H', g, off, struct.unpack_from('<H', g, off)[0] + bases[kind])
+  return bytes(g)
+
+def ac7make_load_manifest(fn):
+  # Read an incremental build manifest, as written by ac7make_save_manifest(). If the
+  # file doesn't exist or was made by a different version, returns an empty
+  # manifest.
+  
+  m = {}
+  if os.path.isfile(fn):
+    with open(fn, "rb") as f:
+      m = pickle.load(f)
+  if m.get('version', None) != (MANIFEST_VERSION, __version__):
+    m = {'version': (MANIFEST_VERSION, __version__), 'elements': {}}
+  return m
+
+def ac7make_save_manifest(fn, m):
+  # Write an incremental build manifest
+  
+  with open(fn + ".tmp", "wb") as f:
+    pickle.dump(m, f)
+  os.replace(fn + ".tmp", fn)
+
+def ac7make_write(g2, elements, mixers, drums, others):
+  # Put together the AC7 file from the rhythm-wide data (see
+  # ac7make_element_header) and the vectors of elements, mixers, drum tracks and
+  # other tracks. All the block sizes and addresses are worked out first, and then
+  # everything is written into a single buffer, so the time taken only depends
+  # on the size of the file.
+  
+  if len(mixers) != 96:
+    raise Exception("Expected 96 mixer parts, got {0}".format(len(mixers)))
+  
   # Size of the header. 'AC07' plus start address of each block (4 bytes),
   # plus end address (4 bytes)
-  addr = 0x1C
+  addr_e = 0x1C
+  addr_m = addr_e + ac7make_element_block_size(g2, elements)
+  addr_d = addr_m + ac7make_block_size(mixers)
+  addr_o = addr_d + ac7make_block_size(drums)
+  addr = addr_o + ac7make_block_size(others)
   
-  g1 = b''
+  g = bytearray(addr)
+  mv = memoryview(g)
+  # End-of-list indicator after the block addresses
+  struct.pack_into('<4s6I', mv, 0, b'AC07', addr, addr_e, addr_m, addr_d, addr_o, 0xffffffff)
+  # The "elements" block addresses are relative to the block, others are absolute
+  ac7make_write_element_block(mv, addr_e, g2, elements, 0)
+  ac7make_write_block(mv, addr_m, b'MIXR', mixers, addr_m)
+  ac7make_write_block(mv, addr_d, b'DRUM', drums, addr_d)
+  ac7make_write_block(mv, addr_o, b'OTHR', others, addr_o)
+  mv.release()
+  return bytes(g)
+
+def ac7maker(b, *, cache=None, manifest=None):
+  # The main routine. Create the different parts of the AC7 file (header, ELMT,
+  # MIXR, DRUM, OTHER) and return them concatenated together.
+  #
+  # "cache" is an optional internal.sourcecache.SourceCache, which may be shared
+  # between builds. If not given, a new one is used for this build only so that
+  # each source file is still only read & parsed once.
+  #
+  # "manifest" is an optional dictionary as returned by ac7make_load_manifest(). If
+  # given, the build is incremental: elements whose inputs are unchanged since the
+  # manifest was last updated are re-used rather than encoded again, and the
+  # manifest is updated with the results of this build.
   
-  g1 += struct.pack('<I', addr)
-  g5 = ac7make_element(b, elements, 0)
-  addr += len(g5)
+  if cache is None:
+    cache = SourceCache()
   
-  g1 += struct.pack('<I', addr)
-
-  g2 = ac7make_mixer(mixers, addr)
-
-  addr += len(g2)
-
-  g1 += struct.pack('<I', addr)
-  g3 = ac7make_drum(drums, addr)
-  addr += len(g3)
-
-  g1 += struct.pack('<I', addr)
-  g4 = ac7make_other(others, addr)
-  addr += len(g4)
+  elements = []
+  mixers = []
+  drums = []
+  others = []
+  
+  for el in range(1,13):
+    if manifest is not None:
+      h = ac7make_element_hash(b, el, cache)
+      old = manifest['elements'].get(el, None)
+      if old is None:
+        enc = ac7make_encode_element(b, el, cache)
+        manifest['elements'][el] = {'hash': h, 'encoded': enc}
+      elif old['hash'] != h:
+        # Something has changed. Any tracks which haven't changed can still be
+        # re-used from the old encoding.
+        enc = ac7make_encode_element(b, el, cache, old['encoded']['tracks'])
+        manifest['elements'][el] = {'hash': h, 'encoded': enc}
+      else:
+        enc = old['encoded']
+    else:
+      enc = ac7make_encode_element(b, el, cache)
+    
+    # Re-link the element so that its entries follow on from the previous elements
+    elements.append(ac7make_link_element(enc, {'drums': len(drums), 'others': len(others), 'mixers': len(mixers)}))
+    drums += enc['drums']
+    others += enc['others']
+    mixers += enc['mixers']
 
-  # End-of-list indicator
-  g1 += struct.pack('<I', 0xffffffff)
 
-  g1 = b'AC07' + struct.pack('<I', addr) + g1
+  return ac7make_write(ac7make_element_header(b), elements, mixers, drums, others)
 
-  return (g1 + g5 + g2 + g3 + g4)
 
+def ac7make_build_file(json_file, out_file, *, cache_dir=None, manifest_file=None):
+  # Make an AC7 file from a JSON definition file. Used by the batch mode of the
+  # command line, so everything is passed by file name. Returns the time taken
+  # in seconds.
+  
+  st = time.monotonic()
+  with open(json_file, "r") as f1:
+    b = json.load(f1)
+  b["input_dir"] = os.path.dirname(json_file)
+  manifest = None
+  if manifest_file is not None:
+    manifest = ac7make_load_manifest(manifest_file)
+  g = ac7maker(b, cache=SourceCache(cache_dir), manifest=manifest)
+  with open(out_file, "wb") as f2:
+    f2.write(g)
+  if manifest is not None:
+    ac7make_save_manifest(manifest_file, manifest)
+  return time.monotonic() - st
+
+def ac7make_batch(json_files, out_dir, *, jobs=None, cache_dir=None, manifest_dir=None):
+  # Make AC7 files from many JSON definition files, spread over a pool of "jobs"
+  # processes. Output files are written to "out_dir", named after the JSON files.
+  # A failure of one rhythm doesn't stop the others. Progress is reported on the
+  # standard error, and the number of failures is returned. JSON files with the
+  # same name (in different directories) would be made into the same output
+  # file, so none are made if there are any.
+  
+  names = {}
+  for jf in json_files:
+    name = os.path.normcase(os.path.splitext(os.path.basename(jf))[0])
+    names.setdefault(name, []).append(jf)
+  clashes = [x for x in names.values() if len(x) > 1]
+  if len(clashes) > 0:
+    raise Exception("JSON files with the same name would be made into the same AC7 file: {0}".format(
+                    "; ".join(", ".join(x) for x in clashes)))
+  
+  os.makedirs(out_dir, exist_ok=True)
+  if manifest_dir is not None:
+    os.makedirs(manifest_dir, exist_ok=True)
+  failures = 0
+  st = time.monotonic()
+  with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as ex:
+    futures = {}
+    for jf in json_files:
+      name = os.path.splitext(os.path.basename(jf))[0]
+      out_file = os.path.join(out_dir, name + ".AC7")
+      manifest_file = None
+      if manifest_dir is not None:
+        manifest_file = os.path.join(manifest_dir, name + ".manifest")
+      futures[ex.submit(ac7make_build_file, jf, out_file, cache_dir=cache_dir, manifest_file=manifest_file)] = (jf, out_file)
+    for fut in concurrent.futures.as_completed(futures):
+      (jf, out_file) = futures[fut]
+      try:
+        t = fut.result()
+        sys.stderr.write("{0} -> {1} : {2:.3f} s\n".format(jf, out_file, t))
+      except Exception as e:
+        failures += 1
+        sys.stderr.write("{0} : FAILED : {1}\n".format(jf, repr(e)))
+  sys.stderr.write("Made {0} of {1} rhythms in {2:.3f} s\n".format(len(json_files) - failures, len(json_files), time.monotonic() - st))
+  return failures
 
 
 #
 # USAGE:
 #  python3 ac7maker.py <input .json file>
 #  python3 ac7maker.py   <   <pipe>
+#  python3 ac7maker.py -o <output dir> [--jobs N] <input .json file> ...
+#
+# Options:
+#  --cache-dir <dir>    Keep parsed MIDI data in <dir>, so that unchanged MIDI
+#                       files needn't be parsed again by later builds
+#  --manifest <file>    Incremental build. Only the elements whose definitions or
+#                       source files have changed since the last build with the
+#                       same <file> are encoded again. In batch mode, <file> is a
+#                       directory holding one manifest per rhythm
+#  -o, --output-dir <dir>
+#                       Batch mode. Make an AC7 file in <dir> for each of the input
+#                       files, named after the input file (e.g. "rock.json" is made
+#                       into "rock.AC7"), so the names must all be different.
+#                       Timings and failures of each rhythm are written to the
+#                       standard error
+#  -j, --jobs N         Number of processes to use in batch mode. Default is the
+#                       number of CPUs
 #
 
 
 if __name__=="__main__":
   if sys.version_info[0] < 3:
     raise Exception("Only for use with Python 3! (Found {0}.{1})".format(sys.version_info[0], sys.version_info[1]))
-  if len(sys.argv) < 2:
+  parser = argparse.ArgumentParser(description="Make a Casio AC7 rhythm from a JSON definition and MIDI files. The AC7 file is written to the standard output.")
+  parser.add_argument("json_file", nargs="*", help="the JSON definition of the rhythm. If not given, it is read from the standard input")
+  parser.add_argument("--cache-dir", default=None, help="directory in which to keep parsed MIDI data between builds")
+  parser.add_argument("--manifest", default=None, help="incremental build: file in which to record the encoded elements and their inputs (a directory in batch mode)")
+  parser.add_argument("-o", "--output-dir", default=None, help="batch mode: directory to write an AC7 file for each JSON file to")
+  parser.add_argument("-j", "--jobs", type=int, default=None, help="number of processes to use in batch mode")
+  args = parser.parse_args()
+  if args.output_dir is not None:
+    # Batch mode
+    sys.exit(1 if ac7make_batch(args.json_file, args.output_dir, jobs=args.jobs, cache_dir=args.cache_dir, manifest_dir=args.manifest) > 0 else 0)
+  if len(args.json_file) > 1:
+    parser.error("more than one JSON file needs an output directory (-o)")
+  cache = SourceCache(args.cache_dir)
+  manifest = None
+  if args.manifest is not None:
+    manifest = ac7make_load_manifest(args.manifest)
+  if len(args.json_file) == 0:
     if not sys.stdin.isatty():
       # sysin has some data being piped in. In this case, we don't know where the
       # JSON is stored so MIDI files are just searched for in the current directory.
       # If they're not there, then this won't work - use the named file method instead
       # in that case
-      sys.stdout.buffer.write(ac7maker(sys.stdin.read()))
+      sys.stdout.buffer.write(ac7maker(json.load(sys.stdin), cache=cache, manifest=manifest))
     else:
       sys.stderr.write("Returning : no input\n")
       # No input, nothing to do
       sys.exit(0)
-  elif len(sys.argv) == 2:
+  else:
     # write to standard out
-    with open(sys.argv[1], "r") as f1:
+    with open(args.json_file[0], "r") as f1:
       b = json.load(f1)
-    b["input_dir"] = os.path.dirname(sys.argv[1])
-    sys.stdout.buffer.write(ac7maker(b))
-
+    b["input_dir"] = os.path.dirname(args.json_file[0])
+    sys.stdout.buffer.write(ac7maker(b, cache=cache, manifest=manifest))
+  if manifest is not None:
+    ac7make_save_manifest(args.manifest, manifest)
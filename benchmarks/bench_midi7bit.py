@@ -0,0 +1,171 @@
+#! /usr/bin/python3
+
+##
+#
+# Benchmark of the 7-bit sysex codec (internal/midi7bit.py). First checks the
+# codec against a simple reference version on random data of every length up to a
+# few groups (so every size of partial group at the end is covered) and some longer
+# ones, then times encoding & decoding for payloads from 1 byte up to the size of a
+# large AC7 file, and the example AC7 files themselves.
+#
+# The reference version follows the definition one byte at a time, the way the
+# codec originally did, and is timed as well as a baseline.
+#
+#
+# Usage:
+#
+#   python3 benchmarks/bench_midi7bit.py [-r ROUNDS] [--seed SEED] [--no-reference]
+#
+
+import argparse
+import glob
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from internal.midi7bit import midi_7bit_to_8bit
+from internal.midi7bit import midi_8bit_to_7bit
+from internal.midi7bit import Midi7BitDecoder
+
+
+# Payload sizes to time, in bytes. 0x80 is the size of one HBS/HBR packet, and
+# 65536 is larger than any AC7 file the keyboard will take
+SIZES = [1, 7, 8, 0x80, 1000, 8192, 65536]
+
+
+def ref_8bit_to_7bit(b):
+  # Reference encoder. Each group of 7 bytes becomes 8 bytes of 7 bits, lowest
+  # first; a partial group at the end (or an empty string) is followed by its left
+  # over bits
+  c = bytearray()
+  r = 0
+  n = 0
+  for x in b:
+    c.append(r | ((x << n) & 0x7F))
+    r = x >> (7-n)
+    n += 1
+    if n == 7:
+      c.append(r)
+      r = 0
+      n = 0
+  if n > 0 or len(b) == 0:
+    c.append(r)
+  return bytes(c)
+
+
+def ref_7bit_to_8bit(b):
+  # Reference decoder. The opposite of the above; the bits left over at the end
+  # must all be zero
+  c = bytearray()
+  r = 0
+  n = 0
+  for (i, x) in enumerate(b):
+    if x >= 128:
+      raise Exception("Not valid 7-bit data at position {0} : {1:02X}!".format(i, x))
+    if n == 0:
+      r = x
+    else:
+      c.append(((x << (8-n)) & 0xFF) | r)
+      r = x >> n
+    n = (n+1) % 8
+  if r != 0:
+    raise Exception("Left over data! Probably an error")
+  return bytes(c)
+
+
+def outcome(f, *args):
+  # Result of f(*args), or the exception message
+  try:
+    return ('ok', f(*args))
+  except Exception as e:
+    return ('error', str(e))
+
+
+def decode_streamed(rng, b):
+  # Decode "b" with a Midi7BitDecoder, in random-sized pieces
+  dec = Midi7BitDecoder(io.BytesIO())
+  i = 0
+  while i < len(b):
+    k = rng.randrange(0, 20)
+    dec.write(b[i:i+k])
+    i += k
+  dec.flush()
+  return dec.sink.getvalue()
+
+
+def check(rng, rounds):
+  # Random round trips, and decoding of random (often invalid) 7-bit data. Returns
+  # the number of cases checked
+  lengths = list(range(0, 3*8*7)) + [0x80, 0x81, 1000, 8191]
+  count = 0
+  for r in range(rounds):
+    for n in lengths:
+      d = bytes(rng.randrange(256) for i in range(n))
+      e = midi_8bit_to_7bit(d)
+      if e != ref_8bit_to_7bit(d):
+        raise Exception("Encoding of {0} bytes doesn't match the reference: {1}".format(n, d.hex()))
+      if len(e) != n + n//7 + (1 if n%7 > 0 or n == 0 else 0) or (len(e) > 0 and max(e) >= 128):
+        raise Exception("Bad encoding of {0} bytes: {1}".format(n, d.hex()))
+      if midi_7bit_to_8bit(e) != d and not (n == 0 and midi_7bit_to_8bit(e) == b''):
+        raise Exception("Round trip of {0} bytes failed: {1}".format(n, d.hex()))
+
+      # Any 7-bit data, which may leave bits over or have bytes that aren't 7-bit
+      x = bytearray(rng.randrange(128) for i in range(n))
+      if n > 0 and rng.random() < 0.2:
+        x[rng.randrange(n)] |= 0x80
+      if n > 0 and rng.random() < 0.5:
+        # Clear the bits that would be left over
+        x[-1] &= (0x7F >> (n%8 - 1)) if n%8 > 0 else 0x7F
+      x = bytes(x)
+      expected = outcome(ref_7bit_to_8bit, x)
+      if outcome(midi_7bit_to_8bit, x) != expected:
+        raise Exception("Decoding of {0} bytes doesn't match the reference: {1}".format(n, x.hex()))
+      if outcome(decode_streamed, rng, x) != expected:
+        raise Exception("Streamed decoding of {0} bytes doesn't match the reference: {1}".format(n, x.hex()))
+      count += 1
+  return count
+
+
+def rate(f, b, min_time=0.2):
+  # Throughput of f(b) in MB/s (of the 8-bit data), timed over at least "min_time"
+  n = 0
+  t0 = time.perf_counter()
+  while True:
+    f(b)
+    n += 1
+    t = time.perf_counter() - t0
+    if t >= min_time:
+      break
+  return (n*len(b)/t) / 1e6
+
+
+if __name__=="__main__":
+  parser = argparse.ArgumentParser(description="Benchmark of the 7-bit sysex codec")
+  parser.add_argument("-r", "--rounds", type=int, default=5, help="Number of times to check each length")
+  parser.add_argument("--seed", type=int, default=1, help="Seed for the random data")
+  parser.add_argument("--no-reference", action="store_true", help="Don't time the reference version")
+  args = parser.parse_args()
+
+  rng = random.Random(args.seed)
+  print("Checked {0} cases".format(check(rng, args.rounds)))
+
+  payloads = [("{0} bytes".format(n), bytes(rng.randrange(256) for i in range(n))) for n in SIZES]
+  examples = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "examples")
+  for fn in sorted(glob.glob(os.path.join(examples, "*.AC7"))):
+    with open(fn, "rb") as f:
+      payloads.append((os.path.basename(fn), f.read()))
+
+  header = "{0:20s} {1:>12s} {2:>12s}".format("Payload", "Encode MB/s", "Decode MB/s")
+  if not args.no_reference:
+    header += " {0:>12s} {1:>12s}".format("Ref encode", "Ref decode")
+  print(header)
+  for (name, d) in payloads:
+    e = midi_8bit_to_7bit(d)
+    # Decoding is timed per 8-bit byte, the same as encoding
+    s = "{0:20s} {1:12.2f} {2:12.2f}".format(name, rate(midi_8bit_to_7bit, d), rate(midi_7bit_to_8bit, e)*len(d)/len(e))
+    if not args.no_reference:
+      s += " {0:12.2f} {1:12.2f}".format(rate(ref_8bit_to_7bit, d), rate(ref_7bit_to_8bit, e)*len(d)/len(e))
+    print(s)
@@ -0,0 +1,170 @@
+#! /usr/bin/python3
+
+##
+#
+# Benchmark of MIDI file parsing (internal/midifiles.py). Makes a large MIDI file
+# of random events, then times:
+#
+#   per-event       Decoding one event at a time with consume_midi_time() and
+#                   MidiParser.consume_midi_event(), as the parser used to
+#   tokenize        Splitting the tracks into events with midifile_tokenize(),
+#                   without decoding them
+#   read            Parsing the whole file with MidiParser.read()
+#   read filtered   Parsing the file for the notes of one channel only, as
+#                   ac7maker.py does
+#
+# and prints the number of events per second for each. The decoded events are
+# checked to be the same both ways.
+#
+#
+# Usage:
+#
+#   python3 benchmarks/bench_midifiles.py [-n EVENTS_PER_TRACK] [-t TRACKS] [-r REPEATS]
+#
+
+import argparse
+import os
+import random
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import internal.midifiles as midifiles
+
+
+def midi_vlq(v):
+  # Variable-length quantity, as used for times in MIDI files
+  b = bytes([v&0x7F])
+  v >>= 7
+  while v > 0:
+    b = bytes([0x80 | (v&0x7F)]) + b
+    v >>= 7
+  return b
+
+
+def make_track(rng, n, ch):
+  # Random track data, mostly notes on channel "ch", with some of every other type
+  # of event. Running status is used where possible, as many sequencers do.
+  b = bytearray()
+  status = 0
+  for i in range(n):
+    b += midi_vlq(rng.choice((0, 0, 12, 24, 96, 480)))
+    r = rng.random()
+    c = ch
+    if r < 0.05:
+      # Events on another channel, as in a Type 0 file
+      c = rng.randrange(16)
+      r = rng.random()*0.9
+    if r < 0.75:
+      s = rng.choice((0x80, 0x90)) | c
+      d = bytes([rng.randrange(128), rng.randrange(128)])
+    elif r < 0.85:
+      s = 0xB0 | c
+      d = bytes([rng.choice((1, 7, 10, 11, 64, 100, 101, 6, 38)), rng.randrange(128)])
+    elif r < 0.9:
+      s = 0xE0 | c
+      d = bytes([rng.randrange(128), rng.randrange(128)])
+    elif r < 0.93:
+      s = rng.choice((0xC0, 0xD0)) | c
+      d = bytes([rng.randrange(128)])
+    elif r < 0.97:
+      # Text
+      s = 0xFF
+      d = b'\x01\x08' + b'abcdefgh'
+    elif r < 0.99:
+      # Tempo
+      s = 0xFF
+      d = b'\x51\x03' + struct.pack('>I', 500000)[1:]
+    else:
+      s = 0xF0
+      d = b'\x05\x7E\x7F\x09\x01\xF7'
+    if s == status and s < 0xF0:
+      b += d
+    else:
+      b += bytes([s]) + d
+    if s < 0xF0:
+      status = s
+    else:
+      status = 0
+  b += b'\x00\xFF\x2F\x00'
+  return bytes(b)
+
+
+def make_file(n, num_tracks, seed=1):
+  rng = random.Random(seed)
+  b = b'MThd' + struct.pack('>IHHH', 6, 1, num_tracks, 480)
+  for t in range(num_tracks):
+    d = make_track(rng, n, t%16)
+    b += b'MTrk' + struct.pack('>I', len(d)) + d
+  return b
+
+
+def read_per_event(b):
+  # Parse the file one event at a time, the way MidiParser.iter_track() used to
+  (division, chunks) = midifiles.midifile_chunks(b)
+  trks = []
+  for (pos, x) in chunks:
+    d = b[pos:pos+x]
+    parser = midifiles.MidiParser()
+    trk = []
+    p = 0
+    total_time = 0
+    while p < len(d):
+      (c, p) = midifiles.consume_midi_time(d, p)
+      (e, p) = parser.consume_midi_event(d, p)
+      total_time += c
+      if e is not None:
+        e.time = midifiles.ticks_from_file(total_time, division)
+        trk.append(e)
+    trks.append(trk)
+  return trks
+
+
+def tokenize(b):
+  (division, chunks) = midifiles.midifile_chunks(b)
+  return [midifiles.midifile_tokenize(b[pos:pos+x]) for (pos, x) in chunks]
+
+
+def best_time(f, repeats):
+  best = None
+  for i in range(repeats):
+    t0 = time.perf_counter()
+    x = f()
+    t = time.perf_counter() - t0
+    if best is None or t < best:
+      best = t
+  return (best, x)
+
+
+if __name__=="__main__":
+  parser = argparse.ArgumentParser(description="Benchmark of MIDI file parsing")
+  parser.add_argument("-n", "--events", type=int, default=50000, help="Events per track")
+  parser.add_argument("-t", "--tracks", type=int, default=8, help="Number of tracks")
+  parser.add_argument("-r", "--repeats", type=int, default=3, help="Number of times to run each benchmark; the best is reported")
+  args = parser.parse_args()
+
+  b = make_file(args.events, args.tracks)
+  num_events = sum(len(x) for x in tokenize(b))
+  print("{0} tracks, {1} events, {2} bytes".format(args.tracks, num_events, len(b)))
+
+  (t_base, base) = best_time(lambda: read_per_event(b), args.repeats)
+  filtered = midifiles.MidiParser(channels={1}, kinds={midifiles.NOTE_ON, midifiles.NOTE_OFF})
+  tests = [
+    ("per-event", t_base),
+    ("tokenize", best_time(lambda: tokenize(b), args.repeats)[0]),
+  ]
+  (t, trks) = best_time(lambda: midifiles.MidiParser().read(b), args.repeats)
+  tests.append(("read", t))
+  (t, trks_filtered) = best_time(lambda: filtered.read(b), args.repeats)
+  tests.append(("read filtered", t))
+
+  # Check the results are the same
+  if [[e.to_dict() for e in trk] for trk in trks] != [[e.to_dict() for e in trk] for trk in base]:
+    raise Exception("Events from MidiParser.read() don't match")
+  expected = [[e.to_dict() for e in trk if e.channel == 1 and e.type in filtered.kinds] for trk in base]
+  if [[e.to_dict() for e in trk] for trk in trks_filtered] != expected:
+    raise Exception("Events from filtered MidiParser.read() don't match")
+
+  for (name, t) in tests:
+    print("{0:16s} {1:8.3f} s  {2:12,.0f} events/s  x{3:.2f}".format(name, t, num_events/t, t_base/t))
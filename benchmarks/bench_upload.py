@@ -0,0 +1,250 @@
+#! /usr/bin/python3
+
+##
+#
+# Benchmark of AC7 uploads (internal/sysex_comms_internal.py), waiting for each
+# HBS packet to be ACKed versus pipelined uploads with several packets in flight.
+# No keyboard is needed: a simulated one is run on the other end of a socket pair.
+#
+# The simulated keyboard:
+#
+#   - sends active sensing every 300ms, as a real one does
+#   - takes "latency" to get each packet, and the same again for its reply
+#   - takes "process" to handle each HBS packet, one at a time, then ACKs it (the
+#     ACK then takes "latency" to arrive, while the next packet is handled)
+#   - says it's busy (packet type 0xB) if "queue" HBS packets are already waiting,
+#     or at random with probability "busy", and throws the new one away
+#   - says it's busy to HBS packets with more than "accept" bytes of data, and
+#     throws them away
+#   - if "drop" is given, throws away packets at random with that probability.
+#     After that it ignores everything until nothing has been sent for 50ms, as if
+#     it had lost track of the transfer
+#   - if "lose-ack" or "lose-busy" are given, its ACK or busy replies are lost on
+#     the way back with that probability (for an ACK, after the data was taken)
+#
+# Each upload is checked to have arrived complete & in order. Times include the
+# fixed pauses at the start and end of every upload (1s in all). An upload that
+# goes wrong is started again from the beginning (see upload_ac7_internal()); the
+# number of times is shown as "Restarts".
+#
+# With "--chunk 0", each upload finds the largest packet the simulated keyboard
+# takes (see SysexSession.probe_chunk_size()). The result is kept in a temporary
+# file, not with the results for real keyboards, and is forgotten before each
+# upload so that the time includes the probing. The simulated keyboard's replies
+# give a model ID of 19 01, the same as a CT-X3000.
+#
+#
+# Usage:
+#
+#   python3 benchmarks/bench_upload.py [--size BYTES] [--latency MS] [--process MS]
+#                                      [--queue N] [--drop P] [--windows N,N,...]
+#                                      [--accept BYTES] [--chunk BYTES]
+#                                      [--lose-ack P] [--lose-busy P] [--busy P]
+#
+
+import argparse
+import os
+import queue
+import random
+import shelve
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import internal.sysex_comms_internal as sysex
+from internal.midi7bit import midi_7bit_to_8bit
+
+
+class SimulatedKeyboard:
+
+  def __init__(self, latency, process, queue_size, drop, accept, lose_ack=0.0, lose_busy=0.0, busy=0.0, seed=1):
+    (self.sock, self._sock) = socket.socketpair()
+    self.latency = latency
+    self.process = process
+    self.queue_size = queue_size
+    self.drop = drop
+    self.accept = accept
+    self.lose_ack = lose_ack
+    self.lose_busy = lose_busy
+    self.busy = busy
+    # One for each thread, so that runs are repeatable
+    self.rng = random.Random(seed)
+    self._read_rng = random.Random(seed+1)
+    self.received = bytearray()
+    self.num_busy = 0
+    self.num_dropped = 0
+    self.num_lost = 0
+    self.num_starts = 0
+    self._queue = queue.Queue()
+    self._out = queue.Queue()
+    self._lock = threading.Lock()
+    self._closed = False
+    self._threads = [threading.Thread(target=self._read, daemon=True),
+                     threading.Thread(target=self._work, daemon=True),
+                     threading.Thread(target=self._deliver, daemon=True),
+                     threading.Thread(target=self._sense, daemon=True)]
+    for t in self._threads:
+      t.start()
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def close(self):
+    self._closed = True
+    self._queue.put(None)
+    self._out.put(None)
+    for s in (self.sock, self._sock):
+      try:
+        s.close()
+      except OSError:
+        # Already closed after a time-out
+        pass
+
+  def _send(self, pkt):
+    with self._lock:
+      try:
+        self._sock.send(pkt)
+      except OSError:
+        pass
+
+  def _deliver(self):
+    # Send replies once their latency has passed
+    while True:
+      x = self._out.get()
+      if x is None:
+        return
+      (t, pkt) = x
+      d = t - time.monotonic()
+      if d > 0:
+        time.sleep(d)
+      self._send(pkt)
+
+  def _sense(self):
+    while not self._closed:
+      self._send(b'\xfe')
+      time.sleep(0.3)
+
+  def _read(self):
+    # Split what's received into packets, & queue them with their arrival time
+    buf = b''
+    while True:
+      try:
+        d = self._sock.recv(4096)
+      except OSError:
+        return
+      if not d:
+        return
+      buf += d
+      while b'\xf7' in buf:
+        i = buf.index(b'\xf7')
+        pkt = buf[buf.find(b'\xf0'):i+1]
+        buf = buf[i+1:]
+        if pkt[5] == 5 and (self._queue.qsize() >= self.queue_size or self._read_rng.random() < self.busy):
+          self.num_busy += 1
+          if self._read_rng.random() < self.lose_busy:
+            self.num_lost += 1
+          else:
+            self._send(sysex.make_packet(command=0xB))
+          continue
+        self._queue.put((time.monotonic() + self.latency, pkt))
+
+  def _work(self):
+    lost = False
+    last = 0.0
+    while True:
+      x = self._queue.get()
+      if x is None:
+        return
+      (t, pkt) = x
+      gap = t - last
+      last = t
+      d = t - time.monotonic()
+      if d > 0:
+        time.sleep(d)
+      command = pkt[5]
+      if command == 5:
+        if pkt[10] + 128*pkt[11] > self.accept:
+          # Too large
+          self.num_busy += 1
+          if self.rng.random() < self.lose_busy:
+            self.num_lost += 1
+          else:
+            self._out.put((time.monotonic() + self.latency, sysex.make_packet(command=0xB)))
+          continue
+        if lost and gap < 0.05:
+          continue
+        lost = False
+        if self.drop > 0 and self.rng.random() < self.drop:
+          self.num_dropped += 1
+          lost = True
+          continue
+        time.sleep(self.process)
+        self.received += midi_7bit_to_8bit(pkt[12:-6])
+      elif command == 8:
+        # Start of bulk transfer
+        self.received = bytearray()
+        lost = False
+        self.num_starts += 1
+      else:
+        continue
+      if command == 5 and self.rng.random() < self.lose_ack:
+        self.num_lost += 1
+        continue
+      self._out.put((time.monotonic() + self.latency, sysex.make_packet(command=0xA)))
+
+
+def run(data, window, args):
+  kb = SimulatedKeyboard(args.latency/1000.0, args.process/1000.0, args.queue, args.drop, args.accept,
+                         args.lose_ack, args.lose_busy, args.busy)
+  with shelve.open(sysex.CHUNK_SIZE_DB) as db:
+    db.clear()
+  try:
+    t0 = time.monotonic()
+    try:
+      sysex.upload_ac7_internal(0, data, window=window, chunk_size=args.chunk, fs=kb.fileno())
+    except sysex.SysexTimeoutError:
+      return (None, kb)
+    t = time.monotonic() - t0
+    if bytes(kb.received) != data:
+      raise Exception("Upload with window {0} didn't arrive intact".format(window))
+    return (t, kb)
+  finally:
+    kb.close()
+
+
+if __name__=="__main__":
+  parser = argparse.ArgumentParser(description="Benchmark of pipelined AC7 uploads")
+  parser.add_argument("--size", type=int, default=32768, help="Bytes to upload")
+  parser.add_argument("--latency", type=float, default=2.0, help="One-way latency of the connection, in ms")
+  parser.add_argument("--process", type=float, default=1.0, help="Time for the keyboard to handle a packet, in ms")
+  parser.add_argument("--queue", type=int, default=4, help="Packets waiting before the keyboard says it's busy")
+  parser.add_argument("--drop", type=float, default=0.0, help="Probability of the keyboard losing a packet")
+  parser.add_argument("--windows", default="1,2,4,8", help="Windows to try; 1 is waiting for each ACK")
+  parser.add_argument("--accept", type=int, default=0x80, help="Largest packet data the keyboard takes, in bytes")
+  parser.add_argument("--chunk", type=int, default=0x80, help="Bytes of data per packet, or 0 to find the largest the keyboard takes")
+  parser.add_argument("--lose-ack", type=float, default=0.0, help="Probability of an ACK being lost")
+  parser.add_argument("--lose-busy", type=float, default=0.0, help="Probability of a busy reply being lost")
+  parser.add_argument("--busy", type=float, default=0.0, help="Probability of the keyboard saying it's busy to a packet")
+  args = parser.parse_args()
+
+  tmp_dir = tempfile.TemporaryDirectory()
+  sysex.CHUNK_SIZE_DB = os.path.join(tmp_dir.name, "chunk_sizes.shelve")
+
+  rng = random.Random(0)
+  data = bytes(rng.getrandbits(8) for i in range(args.size))
+  print("{0} bytes. Latency {1}ms, processing {2}ms, queue {3}, drop {4}, accept {5}, chunk {6}, lose-ack {7}, lose-busy {8}, busy {9}".format(
+        args.size, args.latency, args.process, args.queue, args.drop, args.accept, args.chunk, args.lose_ack, args.lose_busy, args.busy))
+  print("{0:>6s} {1:>8s} {2:>10s} {3:>8s} {4:>6s} {5:>8s} {6:>6s} {7:>8s}".format("Window", "Time s", "KB/s", "Speed-up", "Busy", "Dropped", "Lost", "Restarts"))
+  base = None
+  for w in [int(x) for x in args.windows.split(",")]:
+    (t, kb) = run(data, w, args)
+    counts = "{0:6d} {1:8d} {2:6d} {3:8d}".format(kb.num_busy, kb.num_dropped, kb.num_lost, max(kb.num_starts - 1, 0))
+    if t is None:
+      print("{0:6d} {1:>8s} {2:>10s} {3:>8s} {4}".format(w, "timeout", "-", "-", counts))
+      continue
+    if base is None:
+      base = t
+    print("{0:6d} {1:8.2f} {2:10.1f} {3:8.2f} {4}".format(w, t, args.size/t/1000.0, base/t, counts))
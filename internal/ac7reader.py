@@ -0,0 +1,270 @@
+##
+#
+# Functions for reading AC7 rhythm files, for example as saved by the keyboard,
+# downloaded with sysex_comms.download_ac7() or made by ac7maker.py.
+#
+# Reading is lazy. Opening a file only reads the header and the address tables of
+# the "elements", "MIXR", "DRUM" and "OTHR" blocks; atoms, mixer settings and track
+# events are decoded when they're asked for. The data itself is never copied: all
+# the objects refer back to a memoryview of the input, which may be an mmap of the
+# file.
+#
+#
+## Classes:
+#
+#   AC7File(data)
+#   =============
+#
+#   data:           The AC7 data. Anything that supports the buffer protocol, e.g.
+#                   bytes, bytearray or mmap.
+#
+# Attributes & methods:
+#
+#   num_elements, num_mixers, num_drums, num_others
+#                   Number of entries in each of the blocks
+#   name            The rhythm name (as a string)
+#   header_atoms()  List of (type, data) for the rhythm-wide atoms
+#   element(el)     AC7Element for element "el" (1-12)
+#   mixer(n)        Mixer entry "n" (0-based) as a 6-byte memoryview
+#   drum_track(n)   AC7Track for DRUM track "n" (0-based)
+#   other_track(n)  AC7Track for OTHR track "n" (0-based)
+#   close()         Releases the data. Must be called before closing an mmap
+#                   passed as "data".
+#
+# Can also be used as a context manager. AC7File.open(fn) returns an AC7File on an
+# mmap of file "fn", which is closed along with the AC7File.
+#
+#
+#   AC7Element
+#   ==========
+#
+#   atoms()         List of (type, data) for all the atoms in the element
+#   atom(type)      Data of the first atom of the given type, or None
+#   tracks()        List of (kind, number, mixer, flags) for each track in the
+#                   element. "kind" is 'drum' or 'other'; "mixer" is a mixer entry
+#                   number or None
+#
+#
+#   AC7Track
+#   ========
+#
+#   data            The track data (memoryview), including any starter
+#   starter         The 3-byte starter of an OTHR track, or None for a DRUM track
+#   events()        Generator of (time, type, value) for each event in the track.
+#                   "time" is absolute, in AC7 ticks (96 per crotchet). Time jumps
+#                   are applied rather than returned
+#
+# Example:
+#
+#    with AC7File.open("examples/EXAMPLE 1.AC7") as ac7:
+#      el = ac7.element(2)
+#      for (kind, n, mixer, flags) in el.tracks():
+#        if kind == 'drum':
+#          print(list(ac7.drum_track(n).events()))
+#
+
+import mmap
+import struct
+import sys
+
+
+class AC7Track:
+
+  def __init__(self, data, has_starter):
+    self.data = data
+    if has_starter:
+      self.starter = data[0:3]
+    else:
+      self.starter = None
+
+  def events(self):
+    p = 0
+    if self.starter is not None:
+      p = 3
+    t = 0
+    while p + 3 <= len(self.data):
+      (d, typ, val) = struct.unpack_from('<3B', self.data, p)
+      p += 3
+      if typ == 0xFF:
+        # Time jump
+        t += d + 256*val
+        continue
+      t += d
+      yield (t, typ, val)
+      if typ == 0xFC:
+        # End of track
+        return
+
+
+def ac7_read_atoms(data, pos, end):
+  # Returns a list of (type, data) for the atoms from position "pos" up to the
+  # 0xFF end atom or position "end"
+
+  atoms = []
+  while pos + 2 <= end:
+    (typ, n) = struct.unpack_from('<2B', data, pos)
+    atoms.append((typ, data[pos+2:pos+2+n]))
+    pos += 2 + n
+    if typ == 0xFF:
+      break
+  return atoms
+
+
+class AC7Element:
+
+  def __init__(self, data):
+    self.data = data
+    self._atoms = None
+
+  def atoms(self):
+    if self._atoms is None:
+      self._atoms = ac7_read_atoms(self.data, 0, len(self.data))
+    return self._atoms
+
+  def atom(self, typ):
+    for (t, d) in self.atoms():
+      if t == typ:
+        return d
+    return None
+
+  def tracks(self):
+    e_20 = self.atom(0x20)
+    e_21 = self.atom(0x21)
+    e_22 = self.atom(0x22)
+    if e_20 is None or e_21 is None or e_22 is None:
+      return []
+    trks = []
+    for i in range(len(e_22)):
+      pt = e_22[i] & 0x0F
+      n = struct.unpack_from('<H', e_20, 2*i)[0] & 0x7FFF
+      mx = struct.unpack_from('<H', e_21, 2*i)[0]
+      if mx == 0xFFFF:
+        mx = None
+      else:
+        mx &= 0x7FFF
+      # Part 1 & 2 (nibble 0x0F & 0x00) are drum parts
+      if pt == 0x0F or pt == 0x00:
+        kind = 'drum'
+      else:
+        kind = 'other'
+      trks.append((kind, n, mx, e_22[i] & 0xF0))
+    return trks
+
+
+class AC7File:
+
+  def __init__(self, data):
+    self._mm = None
+    self.data = memoryview(data)
+    try:
+      self._read_header()
+    except Exception:
+      # Don't keep hold of "data" (e.g. an mmap that is to be closed) while the
+      # exception is being handled
+      self.data.release()
+      raise
+
+  def _read_header(self):
+    if self.data[0:4] != b'AC07':
+      raise Exception("Expected 'AC07' at start of file, got '{0}'".format(bytes(self.data[0:4])))
+    (self.length, addr_e, addr_m, addr_d, addr_o) = struct.unpack_from('<5I', self.data, 4)
+    self._addr_e = addr_e
+
+    # "elements" block. Addresses are relative to the start of the block
+    (magic, size, self.num_elements) = struct.unpack_from('<IHB', self.data, addr_e)
+    if magic != 0x07ffffff:
+      raise Exception("Expected elements block at position {0}".format(addr_e))
+    self._elements = struct.unpack_from('<{0}I'.format(self.num_elements), self.data, addr_e + 7)
+    self._elements_end = addr_e + size
+
+    (self._mixers, self._mixers_end) = self._read_table(addr_m, b'MIXR')
+    (self._drums, self._drums_end) = self._read_table(addr_d, b'DRUM')
+    (self._others, self._others_end) = self._read_table(addr_o, b'OTHR')
+    self.num_mixers = len(self._mixers)
+    self.num_drums = len(self._drums)
+    self.num_others = len(self._others)
+
+  def _read_table(self, addr, name):
+    if self.data[addr:addr+4] != name:
+      raise Exception("Expected '{0}' at position {1}, got '{2}'".format(name.decode('ascii'), addr, bytes(self.data[addr:addr+4])))
+    (size, n) = struct.unpack_from('<IH', self.data, addr+4)
+    return (struct.unpack_from('<{0}I'.format(n), self.data, addr + 10), addr + size)
+
+  @classmethod
+  def open(cls, fn):
+    with open(fn, "rb") as f:
+      mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      x = cls(mm)
+    except Exception:
+      mm.close()
+      raise
+    x._mm = mm
+    return x
+
+  def close(self):
+    self.data.release()
+    if self._mm is not None:
+      try:
+        self._mm.close()
+      except BufferError:
+        # Some parts of the data (e.g. tracks) are still being referred to. The
+        # mmap will be closed once they've been freed.
+        pass
+      self._mm = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def _entry(self, table, end, n):
+    # Entries run up to the start of the next one, or to the end of the block
+    if n + 1 < len(table):
+      return self.data[table[n]:table[n+1]]
+    return self.data[table[n]:end]
+
+  def header_atoms(self):
+    start = self._addr_e + 7 + 4*self.num_elements
+    return ac7_read_atoms(self.data, start, self._elements_end)
+
+  @property
+  def name(self):
+    for (t, d) in self.header_atoms():
+      if t == 0:
+        return bytes(d).split(b'\x00')[0].decode('ascii', errors='replace')
+    return ""
+
+  def element(self, el):
+    p = self._addr_e + self._elements[el-1]
+    if self.data[p:p+4] != b'ELMT':
+      raise Exception("Expected 'ELMT' at position {0}".format(p))
+    n = struct.unpack_from('<H', self.data, p+4)[0]
+    return AC7Element(self.data[p+6:p+n])
+
+  def mixer(self, n):
+    return self._entry(self._mixers, self._mixers_end, n)
+
+  def drum_track(self, n):
+    return AC7Track(self._entry(self._drums, self._drums_end, n), False)
+
+  def other_track(self, n):
+    return AC7Track(self._entry(self._others, self._others_end, n), True)
+
+
+
+if __name__=="__main__":
+  # Print a summary of an AC7 file
+  with AC7File.open(sys.argv[1]) as ac7:
+    print("Name: '{0}'  Elements: {1}  Mixers: {2}  Drum tracks: {3}  Other tracks: {4}".format(ac7.name, ac7.num_elements, ac7.num_mixers, ac7.num_drums, ac7.num_others))
+    for el in range(1, ac7.num_elements+1):
+      e = ac7.element(el)
+      s = ''
+      for (kind, n, mx, flags) in e.tracks():
+        if kind == 'drum':
+          t = ac7.drum_track(n)
+        else:
+          t = ac7.other_track(n)
+        s += " {0}{1}({2} bytes)".format(kind[0].upper(), n, len(t.data))
+      print("Element {0:2d}:{1}".format(el, s))
@@ -2,97 +2,213 @@
 #
 # Functions for encoding and decoding MIDI-style 7-bit byte strings.
 #
+#
+## Classes:
+#
+#   Midi7BitDecoder(sink=None)
+#   ==========================
+#
+# Decodes 7-bit data as it arrives, e.g. the payloads of a series of sysex packets,
+# without collecting it all first.
+#
+#   sink:           <Optional> where to put the decoded data: a bytearray, or any
+#                   object with a write() method (e.g. a file). If None, a new
+#                   bytearray is used.
+#
+# Methods:
+#
+#   write(b)        Decode 7-bit data "b", which continues from the data given to
+#                   the previous write(). Complete groups are decoded straight
+#                   away; a partial group is kept until more data arrives.
+#   flush()         End the current string of 7-bit data, decoding any partial
+#                   group at the end. The next write() starts a new string. The
+#                   result of a write() & flush() is the same as of
+#                   midi_7bit_to_8bit(), including the errors.
+#
+# Example:
+#
+#    dec = Midi7BitDecoder()
+#    for payload in payloads:
+#      dec.write(payload)
+#      dec.flush()
+#    data = dec.sink
+#
 
-import struct
 
 
+# The conversions work on whole groups at once: 8 bytes of 7-bit data hold 7 bytes
+# of 8-bit data, with the lowest bits first. All the complete groups of a byte
+# string are converted together as one (large) integer, with one 64-bit lane per
+# group, by moving the bits in pairs of fields, then pairs of pairs, and so on.
+# Only a partial group at the end, and short strings, are worked out separately: as
+# the groups follow on from each other with no gaps, a partial group can simply be
+# taken as one integer and split into bytes. Short strings (e.g. the CRC of each
+# packet) are quickest to convert one byte at a time.
+
+# Strings of up to this many bytes are converted on their own, as above
+SHORT_STRING = 24
+
+def _lane_mask(pattern, n):
+  # Integer with "pattern" (bytes, lowest first) repeated "n" times
+  return int.from_bytes(pattern*n, 'little')
+
+_masks = {}
+
+def _lane_masks(n):
+  # Masks for "n" groups: the low & high halves of each pair of 7, 14 and 28-bit
+  # fields, at their packed positions. Those for up to a few packets' worth of
+  # groups are kept, as the same sizes are used over and over
+  m = _masks.get(n, None)
+  if m is None:
+    m = (_lane_mask(b'\x7f\x00', 4*n), _lane_mask(b'\x00\x7f', 4*n),
+         _lane_mask(b'\xff\x3f\x00\x00', 2*n), _lane_mask(b'\x00\x00\xff\x3f', 2*n),
+         _lane_mask(b'\xff\xff\xff\x0f\x00\x00\x00\x00', n), _lane_mask(b'\x00\x00\x00\x00\xff\xff\xff\x0f', n))
+    if n <= 64:
+      _masks[n] = m
+  return m
+
+
+def _check_7bit(b, pos=0):
+  # Raise an exception if any of "b" isn't 7-bit data. "pos" is the position of the
+  # start of "b" in the whole string, for the message
+  if len(b) > 0 and max(b) >= 128:
+    for (i, x) in enumerate(b):
+      if x >= 128:
+        raise Exception("Not valid 7-bit data at position {0} : {1:02X}!".format(pos+i, x))
+
+def _decode_groups(b, n):
+  # Decode the first "n" complete groups of "b". Each 7-bit field is moved down next
+  # to the one below it; the top byte of each 64-bit lane is then empty and is
+  # removed
+  if n == 0:
+    return bytearray()
+  (a, a_hi, c, c_hi, e, e_hi) = _lane_masks(n)
+  x = int.from_bytes(b[0:8*n], 'little')
+  x = (x & a) | ((x & a_hi) >> 1)
+  x = (x & c) | ((x & c_hi) >> 2)
+  x = (x & e) | ((x & e_hi) >> 4)
+  out = bytearray(x.to_bytes(8*n, 'little'))
+  del out[7::8]
+  return out
+
+def _decode_partial(b):
+  # Decode a partial group "b" at the end of a string, or a short string, which
+  # must not have any bits left over that don't make up a whole byte
+  x = 0
+  for (k, y) in enumerate(b):
+    x |= y << (7*k)
+  n = (7*len(b))//8
+  if (x >> (8*n)) != 0:
+    raise Exception("Left over data! Probably an error")
+  return x.to_bytes(n, 'little')
 
-def midi_7bit_to_8bit(b):
 
-  r = 0  # remainder
-  n = 0  # position of split
-  i = 0  # pointer to input
-  c = b'' # output
-  
-  
-  while i<len(b):
+def midi_7bit_to_8bit(b):
 
-    x = b[i]
-  
-    if x >= 128:
-      raise Exception("Not valid 7-bit data at position {0} : {1:02X}!".format(i, x))
-
-    if n == 0 or n == 8:
-      r = x
-      n = 0
-    elif n == 1:
-      c += struct.pack('<B', ((x&0x01)<<7) + r)
-      r = x//2
-    elif n == 2:
-      c += struct.pack('<B', ((x&0x03)<<6) + r)
-      r = x//4
-    elif n == 3:
-      c += struct.pack('<B', ((x&0x07)<<5) + r)
-      r = x//8
-    elif n == 4:
-      c += struct.pack('<B', ((x&0x0f)<<4) + r)
-      r = x//16
-    elif n == 5:
-      c += struct.pack('<B', ((x&0x1f)<<3) + r)
-      r = x//32
-    elif n == 6:
-      c += struct.pack('<B', ((x&0x3f)<<2) + r)
-      r = x//64
-    elif n == 7:
-      c += struct.pack('<B', ((x&0x7f)<<1) + r)
-      r = 0
-    i += 1
-    n += 1
-  if r != 0:
-    raise Exception("Left over data! Probably an error")
-  
-  return c
+  if len(b) <= SHORT_STRING:
+    # One byte at a time. Each field's bits make up the top of one byte and the
+    # bottom of the next; the bits left over at the end must all be zero
+    c = bytearray()
+    r = 0
+    n = 0
+    for (i, x) in enumerate(b):
+      if x >= 128:
+        raise Exception("Not valid 7-bit data at position {0} : {1:02X}!".format(i, x))
+      if n == 0:
+        r = x
+      else:
+        c.append(((x << (8-n)) & 0xFF) | r)
+        r = x >> n
+      n = (n+1) % 8
+    if r != 0:
+      raise Exception("Left over data! Probably an error")
+    return bytes(c)
   
+  _check_7bit(b)
   
+  n = len(b)//8   # Number of complete groups
+  out = _decode_groups(b, n)
+  if len(b) > 8*n:
+    out += _decode_partial(b[8*n:])
   
+  return bytes(out)
 
 
 
 def midi_8bit_to_7bit(b):
-  r = 0  # remainder
-  n = 0  # position of split
-  i = 0  # pointer to input
-  c = b'' # output
+
+  if len(b) <= SHORT_STRING:
+    # One byte at a time. Each byte's bits go partly into the current field and
+    # partly into the next; a field is completed after every 7 bytes, and at the
+    # end for any bits left over. An empty string becomes one zero byte
+    c = bytearray()
+    r = 0
+    n = 0
+    for x in b:
+      c.append(r | ((x << n) & 0x7F))
+      r = x >> (7-n)
+      n += 1
+      if n == 7:
+        c.append(r)
+        r = 0
+        n = 0
+    if n > 0 or len(b) == 0:
+      c.append(r)
+    return bytes(c)
+  
+  n = len(b)//7   # Number of complete groups
+  m = len(b)%7    # Bytes in the partial group at the end
+  
+  # Complete groups. Each group of 7 bytes is put in its own 64-bit lane, then the
+  # fields are spread out to 7 bits each
+  (a, a_hi, c, c_hi, e, e_hi) = _lane_masks(n)
+  out = bytearray(8*n)
+  for k in range(7):
+    out[k::8] = b[k:7*n:7]
+  x = int.from_bytes(out, 'little')
+  x = (x & e) | ((x << 4) & e_hi)
+  x = (x & c) | ((x << 2) & c_hi)
+  x = (x & a) | ((x << 1) & a_hi)
+  out = bytearray(x.to_bytes(8*n, 'little'))
+  
+  # Partial group, always followed by the left over bits
+  if m > 0:
+    x = int.from_bytes(b[7*n:], 'little')
+    for k in range(m+1):
+      out.append((x >> (7*k)) & 0x7f)
   
-  while i<len(b):
-    if n == 0 or n == 7:
-      n = 0
-      c += struct.pack('<B', 0x1*(b[i] & 0x7f))
-      r = (b[i] & 0x80)//0x80
-    elif n == 1:
-      c += struct.pack('<B', r + 0x2*(b[i] & 0x3f))
-      r = (b[i] & 0xc0)//0x40
-    elif n == 2:
-      c += struct.pack('<B', r + 0x4*(b[i] & 0x1f))
-      r = (b[i] & 0xe0)//0x20
-    elif n == 3:
-      c += struct.pack('<B', r + 0x8*(b[i] & 0x0f))
-      r = (b[i] & 0xf0)//0x10
-    elif n == 4:
-      c += struct.pack('<B', r + 0x10*(b[i] & 0x07))
-      r = (b[i] & 0xf8)//0x8
-    elif n == 5:
-      c += struct.pack('<B', r + 0x20*(b[i] & 0x03))
-      r = (b[i] & 0xfc)//0x4
-    elif n == 6:
-      c += struct.pack('<B', r + 0x40*(b[i] & 0x01))
-      c += struct.pack('<B', (b[i] & 0xfe)//0x2)
-      r = 0
-    n += 1
-    i += 1
-  if n < 7:
-    c += struct.pack('<B', r)
-  return c
+  return bytes(out)
+
+
+
+class Midi7BitDecoder:
+
+  def __init__(self, sink=None):
+    if sink is None:
+      sink = bytearray()
+    self.sink = sink
+    if hasattr(sink, 'write'):
+      self._put = sink.write
+    else:
+      self._put = sink.extend
+    self._pending = bytearray()  # Partial group not yet decoded
+    self._pos = 0                # Position in the current string of the above
+
+  def write(self, b):
+    _check_7bit(b, self._pos + len(self._pending))
+    self._pending += b
+    n = len(self._pending)//8
+    if n > 0:
+      self._put(_decode_groups(self._pending, n))
+      del self._pending[0:8*n]
+      self._pos += 8*n
+
+  def flush(self):
+    pending = self._pending
+    self._pending = bytearray()
+    self._pos = 0
+    if len(pending) > 0:
+      self._put(_decode_partial(pending))
   
 
 
@@ -1,16 +1,151 @@
 # A library of functions for reading, parsing and writing MIDI files.
 
+import contextlib
+import mmap
+import os
 import struct
 
 
 
-# Implement a "running status" variable. This is required for compatibility with
-# MIDI files as rendered by Traktion Waveform. It's not clear from reading online
-# whether this is part of the official MIDI spec *for files* (as opposed to
-# streamed data, where it definitely is part of the official spec), and it seems
-# to be inconsistently supported by other software. May as well support it here.
-#
-running_status = 0
+# Event times are held as whole numbers of ticks at this resolution, which is the
+# resolution of AC7 rhythms. Times in the file are converted to it exactly, with a
+# single rounding for each event.
+TICKS_PER_CROTCHET = 96
+
+def ticks_from_file(t, division):
+  # Convert a time "t" in ticks of the file (with "division" ticks per crotchet)
+  # to ticks of TICKS_PER_CROTCHET per crotchet. Rounds to the nearest tick, with
+  # halves going to the even tick (as round() does).
+  (q, r) = divmod(TICKS_PER_CROTCHET*t, division)
+  if 2*r > division or (2*r == division and (q&1) == 1):
+    q += 1
+  return q
+
+
+# Events are held as MidiEvent objects, with an integer type code and up to two
+# data values. The codes are:
+NOTE_OFF = 0
+NOTE_ON = 1
+CONTROL_CHANGE = 2
+REGISTERED_PARAM = 3
+PATCH_CHANGE = 4
+PITCH_BEND = 5
+TEMPO_CHANGE = 6
+TIME_SIGNATURE = 7
+TRACK_END = 8
+METADATA = 9
+SYSEX = 10
+
+# For each type code: the name of the event, and the names of its data values
+# (other than "channel"), as used when the event is looked at as a dictionary
+EVENT_NAMES = ['note_off', 'note_on', 'control_change', 'registered_param', 'patch_change', 'pitch_bend',
+               'tempo_change', 'time_signature', 'track_end', 'metadata', 'sysex']
+EVENT_FIELDS = [('note', 'velocity'), ('note', 'velocity'), ('controller', 'value'), ('parameter', 'value'), ('patch',), ('bend',),
+                ('value',), ('numerator', 'log_denominator'), (), ('data',), ('data',)]
+
+# Type codes of the channel messages which don't need any more decoding to tell
+_CHANNEL_KINDS = {0x80: NOTE_OFF, 0x90: NOTE_ON, 0xC0: PATCH_CHANGE, 0xE0: PITCH_BEND}
+
+# Controllers which make up an RPN, and so aren't returned as events themselves
+_RPN_CONTROLLERS = (100, 101, 6, 38)
+
+# Number of data bytes after each status byte. VARIABLE for meta events and system
+# exclusive, whose length is given in the data itself, and None for the status
+# bytes which can't appear in a MIDI file
+VARIABLE = -1
+_DATA_LENGTHS = [None]*256
+for _s in range(0x80, 0xF0):
+  if (_s&0xE0) == 0xC0:
+    # Patch change & channel pressure have one data byte, the others two
+    _DATA_LENGTHS[_s] = 1
+  else:
+    _DATA_LENGTHS[_s] = 2
+_DATA_LENGTHS[0xF0] = VARIABLE
+_DATA_LENGTHS[0xFF] = VARIABLE
+
+# Look-up from type code and field name to the slot holding it
+_SLOTS = []
+for _f in EVENT_FIELDS:
+  _SLOTS.append(dict(zip(_f, ('data1', 'data2'))))
+
+
+class MidiEvent:
+  # A single MIDI event. Much smaller than a dictionary, but can still be used as
+  # one (read-only, apart from the times) with the keys:
+  #
+  #   'event'           Name of the event, e.g. 'note_on'
+  #   'time'            Time in ticks (TICKS_PER_CROTCHET per crotchet)
+  #   'absolute_time'   Time in MIDI clocks (24 per crotchet)
+  #   'channel'         MIDI channel 1-16. Only for channel events
+  #   ...               The names of the data values, as in EVENT_FIELDS
+  
+  __slots__ = ('type', 'time', 'channel', 'data1', 'data2')
+  
+  def __init__(self, type, channel=None, data1=None, data2=None, time=0):
+    self.type = type
+    self.time = time
+    self.channel = channel
+    self.data1 = data1
+    self.data2 = data2
+  
+  @property
+  def absolute_time(self):
+    return self.time * (24.0 / TICKS_PER_CROTCHET)
+  
+  @absolute_time.setter
+  def absolute_time(self, value):
+    self.time = round(value * (TICKS_PER_CROTCHET / 24.0))
+  
+  def __getitem__(self, key):
+    if key == 'event':
+      return EVENT_NAMES[self.type]
+    if key == 'time':
+      return self.time
+    if key == 'absolute_time':
+      return self.absolute_time
+    if key == 'channel':
+      if self.channel is None:
+        raise KeyError(key)
+      return self.channel
+    slot = _SLOTS[self.type].get(key, None)
+    if slot is None:
+      raise KeyError(key)
+    return getattr(self, slot)
+  
+  def __setitem__(self, key, value):
+    if key == 'time':
+      self.time = value
+    elif key == 'absolute_time':
+      self.absolute_time = value
+    else:
+      raise KeyError(key)
+  
+  def get(self, key, default=None):
+    if key == 'channel':
+      # Asked for often, so avoid the exception
+      if self.channel is None:
+        return default
+      return self.channel
+    try:
+      return self[key]
+    except KeyError:
+      return default
+  
+  def keys(self):
+    k = ['event', 'time', 'absolute_time']
+    if self.channel is not None:
+      k.append('channel')
+    return k + list(EVENT_FIELDS[self.type])
+  
+  def __contains__(self, key):
+    return key in self.keys()
+  
+  def to_dict(self):
+    return {k: self[k] for k in self.keys()}
+  
+  def __repr__(self):
+    return "MidiEvent({0})".format(self.to_dict())
+
 
 
 def consume_midi_time(b, pos):
@@ -25,80 +160,198 @@ def consume_midi_time(b, pos):
       return (v, p)
   #print("Got to end!")
 
-# Variables used for tracking RPNs
-c100 = []
-c101 = []
-c6 = []
-c38 = []
 
-def clear_midi_events():
-  global c100
-  global c101
-  global c6
-  global c38
+def midifile_iter_tokens(b):
+  # Generator splitting the data of a track into events without decoding them.
+  # Yields (delta time, status, offset, length) for each event, where "status" has
+  # any running status filled in and "offset" & "length" give the data bytes after
+  # the status byte. Only the lengths of the events are worked out, so this is
+  # much quicker than decoding them all; see MidiParser.iter_track() for how the
+  # tokens are decoded. Each event is found as it's asked for, so nothing needs to
+  # be kept however long the track.
+  lengths = _DATA_LENGTHS
+  pos = 0
+  end = len(b)
+  running_status = 0
+  while pos < end:
+    x = b[pos]
+    pos += 1
+    delta = x&0x7F
+    while x&0x80:
+      x = b[pos]
+      pos += 1
+      delta = 0x80*delta + (x&0x7F)
+    status = b[pos]
+    if status >= 0x80:
+      pos += 1
+      if status >= 0xF0:
+        # Fx cancels running status
+        running_status = 0
+      else:
+        running_status = status
+    elif running_status >= 0x80:
+      status = running_status
+    n = lengths[status]
+    if n is None:
+      raise Exception("Unknown event {0:02X}".format(status))
+    if n == VARIABLE:
+      if status == 0xFF:
+        n = 2 + b[pos+1]
+      else:
+        n = 1 + b[pos]
+    yield (delta, status, pos, n)
+    pos += n
 
-  c100 = [-1]*16
-  c101 = [-1]*16
-  c6 = [-1]*16
-  c38 = [-1]*16
 
-def consume_midi_event(b, pos):
-  global c100
-  global c101
-  global c6
-  global c38
-  global running_status
+def midifile_tokenize(b):
+  # As midifile_iter_tokens(), but returns a list of all the tokens of the track
+  return list(midifile_iter_tokens(b))
 
-  p = pos
-  evt = b[p]
-  
-  if evt >= 0xF0:
-      # Fx cancels running status
-      running_status = 0
-      p += 1
-  elif evt <= 0x7F:
-      if running_status >= 0x80:
-          # Use the running status
-          evt = running_status
+
+class MidiParser:
+  # Holds the state needed while decoding MIDI events, so that any number of
+  # files can be parsed at the same time (e.g. in different threads) as long as
+  # each uses its own MidiParser.
+  #
+  #   read(b)                 Parse a whole MIDI file. Returns a list of tracks,
+  #                           each a list of MidiEvent
+  #   process_track(b, division)
+  #                           Parse the data of a single track
+  #   consume_midi_event(b, pos)
+  #                           Decode one event at position "pos". Returns the
+  #                           event (or None) and the position after it
+  #   decode(b, status, pos)  Decode one event from its status and the position
+  #                           of its data, e.g. a token from midifile_tokenize()
+  #
+  # A parser can be made to only return some of the events, by giving:
+  #
+  #   channels                Set of MIDI channels (1-16) to return events for.
+  #                           Events on other channels are skipped over without
+  #                           being decoded. Default is all channels
+  #   kinds                   Set of event type codes (e.g. NOTE_ON) to return.
+  #                           Other events are skipped, if possible without being
+  #                           decoded. Default is all types
+  
+  def __init__(self, channels=None, kinds=None):
+    # Implement a "running status" variable. This is required for compatibility with
+    # MIDI files as rendered by Traktion Waveform. It's not clear from reading online
+    # whether this is part of the official MIDI spec *for files* (as opposed to
+    # streamed data, where it definitely is part of the official spec), and it seems
+    # to be inconsistently supported by other software. May as well support it here.
+    #
+    self.running_status = 0
+    self.clear_midi_events()
+    
+    self.kinds = kinds
+    if channels is None:
+      self._want_channel = [True]*16
+    else:
+      self._want_channel = [(ch+1) in channels for ch in range(16)]
+    self._filtered = channels is not None or kinds is not None
+    
+    # Which channel messages can be skipped just from their status byte. Meta
+    # events & system exclusive need a look at their data, see _skip()
+    self._skip_status = [False]*256
+    for evt in range(0x80, 0xF0):
+      k = _CHANNEL_KINDS.get(evt&0xF0, None)
+      if not self._want_channel[evt&0x0F]:
+        self._skip_status[evt] = True
+      elif k is not None and kinds is not None and k not in kinds:
+        self._skip_status[evt] = True
+
+  def _skip(self, b, evt, p):
+    # Work out whether an event can be skipped without decoding it, and if so
+    # return the position after it. Otherwise returns -1.
+    if evt == 0xFF:
+      n = b[p+1]
+      if b[p+0]==0x51 and n==3:
+        k = TEMPO_CHANGE
+      elif b[p+0]==0x58 and n==4:
+        k = TIME_SIGNATURE
+      elif b[p+0]==0x2F and n==0:
+        k = TRACK_END
       else:
-          # This is an error condition! The exception at the end of this function
-          # will be triggered.
-          pass
-  else:
-      # Update the running status
-      running_status = evt
-      p += 1
-  
-  
-  # Records of the "Registered parameters" entry
-  if evt == 0xFF:
-    # Meta-event
-    n = b[p+1]
-    if b[p+0]==0x51 and n==3:
-      # Tempo
-      x = 0x10000*b[p+2] + 0x100*b[p+3] + b[p+4]
-      tempo = round(60000000.0 / float(x))
-      # Note this is tempo per quarter note. Depending on the time signature,
-      # may need to adjust to eighth notes.
-      e = {'event':'tempo_change', 'absolute_time':0, 'value':tempo}
-      return (e, p+2+n)
-    elif b[p+0]==0x58 and n==4:
-      e = {'event':'time_signature', 'absolute_time':0, 'numerator':b[p+2], 'log_denominator':b[p+3]}
-      return (e, p+2+n)
-    elif b[p+0]==0x2F and n==0:
-      e = {'event':'track_end', 'absolute_time':0}
-      return (e, p+2+n)
+        k = METADATA
+      if self.kinds is not None and k not in self.kinds:
+        return p+2+n
+    elif evt == 0xF0:
+      if self.kinds is not None and SYSEX not in self.kinds:
+        return p+1+b[p+0]
+    elif evt >= 0x80 and evt < 0xF0:
+      if (evt&0xE0) == 0xC0:
+        # Patch change & channel pressure have one data byte, the others two
+        n = 1
+      else:
+        n = 2
+      if not self._want_channel[evt&0x0F]:
+        return p+n
+      # Controllers are always decoded, as they may be part of an RPN
+      k = _CHANNEL_KINDS.get(evt&0xF0, None)
+      if k is not None and self.kinds is not None and k not in self.kinds:
+        return p+n
+    return -1
+
+  def clear_midi_events(self):
+    # Variables used for tracking RPNs
+    self.c100 = [-1]*16
+    self.c101 = [-1]*16
+    self.c6 = [-1]*16
+    self.c38 = [-1]*16
+
+  def consume_midi_event(self, b, pos):
+    p = pos
+    evt = b[p]
+    
+    if evt >= 0xF0:
+        # Fx cancels running status
+        self.running_status = 0
+        p += 1
+    elif evt <= 0x7F:
+        if self.running_status >= 0x80:
+            # Use the running status
+            evt = self.running_status
+        else:
+            # This is an error condition! The "Unknown event" exception below
+            # will be triggered.
+            pass
     else:
-      e = {'event':'metadata', 'absolute_time':0, 'data': b''}
-    return (e, p+2+n)
-  elif evt == 0xF0:
-    # System exclusive
-    n = b[p+0]
-    e = {'event':'sysex', 'absolute_time':0, 'data': b''}
-    return (e, p+1+n)
-  else:
-    if evt&0xF0 == 0xB0:
+        # Update the running status
+        self.running_status = evt
+        p += 1
+    
+    if self._filtered:
+      q = self._skip(b, evt, p)
+      if q >= 0:
+        return (None, q)
+    
+    n = _DATA_LENGTHS[evt]
+    if n is None:
+      raise Exception("Unknown event {0:02X}".format(evt))
+    if n == VARIABLE:
+      if evt == 0xFF:
+        n = 2 + b[p+1]
+      else:
+        n = 1 + b[p]
+    return (self.decode(b, evt, p), p+n)
+
+  def decode(self, b, evt, p):
+    # Decode the event with status "evt" (after any running status is applied),
+    # whose data starts at position "p". Returns a MidiEvent, or None if there's no
+    # event to return, e.g. for part of an RPN. Controllers update the RPN state,
+    # so must be decoded in order.
+    hi = evt&0xF0
+    if hi == 0x90:
+      # Note on
+      return MidiEvent(NOTE_ON, (evt&0x0F)+1, b[p+0], b[p+1])
+    elif hi == 0x80:
+      # Note off
+      return MidiEvent(NOTE_OFF, (evt&0x0F)+1, b[p+0], b[p+1])
+    elif hi == 0xB0:
       # Controller
+      c100 = self.c100
+      c101 = self.c101
+      c6 = self.c6
+      c38 = self.c38
       ch = evt&0x0F
       if b[p+0] == 100:
         c100[ch] = b[p+1]
@@ -109,92 +362,326 @@ def consume_midi_event(b, pos):
       elif b[p+0] == 38:
         c38[ch] = b[p+1]
       else:
-        e = {'event':'control_change', 'absolute_time':0, 'channel':ch+1, 'controller':b[p+0], 'value':b[p+1]}
-        return (e, p+2)
+        return MidiEvent(CONTROL_CHANGE, ch+1, b[p+0], b[p+1])
+      # Records of the "Registered parameters" entry
       if c100[ch]>=0 and c101[ch]>=0 and c6[ch]>=0 and c38[ch]>=0: # TODO: is 38 optional?
-        e = {'event':'registered_param', 'absolute_time':0, 'channel':ch+1, 'parameter':c100[ch]+128*c101[ch], 'value':c38[ch]+128*c6[ch]}
+        e = MidiEvent(REGISTERED_PARAM, ch+1, c100[ch]+128*c101[ch], c38[ch]+128*c6[ch])
         c100[ch] = -1
         c101[ch] = -1
         c6[ch] = -1
         c38[ch] = -1
-        return (e, p+2)
-      return (None, p+2)
-    elif evt&0xF0 == 0xC0:
-      # Patch change
-      e = {'event':'patch_change', 'absolute_time':0, 'channel':(evt&0x0F)+1, 'patch':b[p+0]}
-      return (e, p+1)
-    elif evt&0xF0 == 0x80:
-      # Note off
-      e = {'event':'note_off', 'absolute_time':0, 'channel':(evt&0x0F)+1, 'note':b[p+0], 'velocity':b[p+1]}
-      return (e, p+2)
-    elif evt&0xF0 == 0x90:
-      # Note on
-      e = {'event':'note_on', 'absolute_time':0, 'channel':(evt&0x0F)+1, 'note':b[p+0], 'velocity':b[p+1]}
-      return (e, p+2)
-    elif evt&0xF0 == 0xE0:
+        return e
+      return None
+    elif hi == 0xE0:
       # Pitch bend. Record it as a signed integer, values -0x2000 -- +0x1FFF
-      e = {'event':'pitch_bend', 'absolute_time':0, 'channel':(evt&0x0F)+1, 'bend':128*b[p+1]+(127&b[p+0])-0x2000}
-      return (e, p+2)
-    elif evt&0xF0 == 0xD0:
+      return MidiEvent(PITCH_BEND, (evt&0x0F)+1, 128*b[p+1]+(127&b[p+0])-0x2000)
+    elif hi == 0xC0:
+      # Patch change
+      return MidiEvent(PATCH_CHANGE, (evt&0x0F)+1, b[p+0])
+    elif hi == 0xD0:
       # Channel pressure. Not handled, but don't fail because of this.
-      return (None, p+1)
-    
-  raise Exception("Unknown event {0:02X}".format(evt))
-
+      return None
+    elif evt == 0xFF:
+      # Meta-event
+      n = b[p+1]
+      if b[p+0]==0x51 and n==3:
+        # Tempo
+        x = 0x10000*b[p+2] + 0x100*b[p+3] + b[p+4]
+        tempo = round(60000000.0 / float(x))
+        # Note this is tempo per quarter note. Depending on the time signature,
+        # may need to adjust to eighth notes.
+        return MidiEvent(TEMPO_CHANGE, None, tempo)
+      elif b[p+0]==0x58 and n==4:
+        return MidiEvent(TIME_SIGNATURE, None, b[p+2], b[p+3])
+      elif b[p+0]==0x2F and n==0:
+        return MidiEvent(TRACK_END)
+      return MidiEvent(METADATA, None, b'')
+    elif evt == 0xF0:
+      # System exclusive
+      return MidiEvent(SYSEX, None, b'')
+    raise Exception("Unknown event {0:02X}".format(evt))
 
-def process_track(b, division):
-    global running_status
-    
-    clear_midi_events()
+  def iter_track(self, b, division):
+    # Generator of the events of a single track, decoded as they're asked for.
+    # The track is split up by midifile_iter_tokens() as it goes, and only the
+    # events which aren't filtered out are decoded.
+    self.clear_midi_events()
+    self.running_status = 0
     
-    pos = 0
+    kinds = self.kinds
+    filtered = self._filtered
+    skip_status = self._skip_status
+    decode = self.decode
     total_time = 0
-    running_status = 0
-    trk = []
-    while pos < len(b):
-    
-      (c, pos) = consume_midi_time(b, pos)
-      (d, pos) = consume_midi_event(b, pos)
+    last_time = -1
+    for (c, evt, p, n) in midifile_iter_tokens(b):
       total_time += c
-      if d != None:
-        # Change time to MIDI clocks (24 per crotchet).
-        d['absolute_time'] = (24.0 / float(division)) * float(total_time)
-        trk.append(d)
-    return trk
+      if skip_status[evt]:
+        continue
+      if filtered and evt >= 0xF0 and self._skip(b, evt, p) >= 0:
+        continue
+      d = decode(b, evt, p)
+      if d is not None and (kinds is None or d.type in kinds):
+        # Change time to TICKS_PER_CROTCHET. This is the only rounding of the
+        # time, so there's no drift however long the track. Many events share a
+        # time, so it's only worked out when it changes.
+        if total_time != last_time:
+          last_time = total_time
+          t = ticks_from_file(total_time, division)
+        d.time = t
+        yield d
 
+  def process_track(self, b, division):
+    return list(self.iter_track(b, division))
 
+  def read(self, b):
+    (division, chunks) = midifile_chunks(b)
+    trks = []
+    for (pos, x) in chunks:
+      with _track_data(b, pos, x) as d:
+        trks.append(self.process_track(d, division))
+    return trks
 
 
-def midifile_read(b):
+def midifile_chunks(b):
+  # Find the tracks in a MIDI file. Returns the division (number of ticks per
+  # quarter note) and a list of (position, length) of the data of each track.
   pos = 0
   if b[pos+0:pos+4] != b'MThd':
     # Bad input
-    raise Exception("Expected 'MThd' at position {0}, got '{1}'".format(pos, b[pos+0:pos+4]))
-    return b''
+    raise Exception("Expected 'MThd' at position {0}, got '{1}'".format(pos, bytes(b[pos+0:pos+4])))
   x = struct.unpack('>I', b[pos+4:pos+8])[0]  # Length of header
   num_trks = struct.unpack('>H', b[pos+10:pos+12])[0]  # Number of tracks in file
   division = struct.unpack('>H', b[pos+12:pos+14])[0]  # Number of ticks per quarter note (1 quarter note = 24 MIDI clocks)
   
-  trks = []
+  chunks = []
   
   pos += 8 + x
   
   for t in range(num_trks):
     if b[pos+0:pos+4] != b'MTrk':
       # Bad input
-      raise Exception("Expected 'MTrk' at position {0}, got '{1}'".format(pos, b[pos+0:pos+4]))
-      return b''
+      raise Exception("Expected 'MTrk' at position {0}, got '{1}'".format(pos, bytes(b[pos+0:pos+4])))
     x = struct.unpack('>I', b[pos+4:pos+8])[0]  # Length of track
-    trk = process_track(b[pos+8:pos+8+x], division)
-    
+    chunks.append((pos+8, x))
     pos += 8 + x
     
-    trks.append(trk)
-    
-  return trks
-    
+  return (division, chunks)
+
+
+@contextlib.contextmanager
+def _track_data(b, pos, x):
+  # The data of the track at "pos" of length "x" in file data "b". If "b" is a
+  # memoryview, the slice is let go of at the end of the "with" block, even if an
+  # exception is raised, so that it can't stop an mmap being closed (see
+  # midifile_map())
+  d = b[pos:pos+x]
+  if isinstance(d, memoryview):
+    with d:
+      yield d
+  else:
+    yield d
+
+
+@contextlib.contextmanager
+def midifile_map(fn):
+  # Context manager giving a read-only memoryview of the contents of file "fn",
+  # through an mmap of the file so that the contents aren't copied into memory.
+  # The file is unmapped at the end of the "with" block, so nothing that refers
+  # to the memoryview must be kept beyond that.
+  with open(fn, "rb") as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      # Can't mmap an empty file
+      yield memoryview(b'')
+      return
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    with memoryview(mm) as b:
+      yield b
+  except BaseException:
+    try:
+      mm.close()
+    except BufferError:
+      # Something in the traceback still refers to the data. The mmap will be
+      # closed once it's been freed; the exception being raised matters more
+      pass
+    raise
+  else:
+    mm.close()
+
+
+def midifile_load(fn, channels=None, kinds=None):
+  # Read and parse MIDI file "fn", the same as midifile_read() but without reading
+  # the whole file into memory first. The tracks are parsed straight from an mmap
+  # of the file.
+  with midifile_map(fn) as b:
+    return midifile_read(b, channels, kinds)
 
 
+def iter_track_events(b, track_index):
+  # Generator of the events of one track of a MIDI file, decoded as they're asked
+  # for. Nothing is kept once it has been handed over, so memory use doesn't
+  # depend on the length of the track.
+  (division, chunks) = midifile_chunks(b)
+  (pos, x) = chunks[track_index]
+  return MidiParser().iter_track(b[pos:pos+x], division)
+
+
+def midifile_demux(trk):
+  # Splits a track holding events on several channels, e.g. the only track of a
+  # Type 0 file, into one track per channel. Returns a dictionary of channel (1-16)
+  # -> list of events. Events without a channel (tempo, time signature, end of
+  # track etc.) are put in every channel's list, so each one can be used like a
+  # track of a Type 1 file. The track is looked through once, in order.
+  chs = {}
+  shared = []
+  for evt in trk:
+    ch = evt.channel
+    if ch is None:
+      shared.append(evt)
+      for x in chs.values():
+        x.append(evt)
+    else:
+      x = chs.get(ch, None)
+      if x is None:
+        # First event on this channel: catch up with the shared events so far
+        x = chs[ch] = list(shared)
+      x.append(evt)
+  return chs
+
+
+def midifile_summary(trks_or_b):
+  # Returns (latest event time, time signature) of a MIDI file, where the time is
+  # in ticks (TICKS_PER_CROTCHET per crotchet) and the time
+  # signature is a (numerator, log_denominator) tuple of the first one in the file,
+  # or None if there isn't one. Accepts either the parsed tracks or the file data;
+  # in the latter case the tracks are only tokenized, and the only events decoded
+  # are time signatures and the controllers which may be part of an RPN.
+  max_time = 0
+  time_sig = None
+  if isinstance(trks_or_b, list):
+    for trk in trks_or_b:
+      for evt in trk:
+        if evt.time > max_time:
+          max_time = evt.time
+        if time_sig is None and evt.type == TIME_SIGNATURE and evt.data1 != 0:
+          time_sig = (evt.data1, evt.data2)
+  else:
+    b = trks_or_b
+    (division, chunks) = midifile_chunks(b)
+    for (pos, x) in chunks:
+      with _track_data(b, pos, x) as d:
+        (t, ts) = _track_summary(d)
+      if t is not None:
+        t = ticks_from_file(t, division)
+        if t > max_time:
+          max_time = t
+      if time_sig is None:
+        time_sig = ts
+  return (max_time, time_sig)
+
+
+def _track_summary(d):
+  # Time (in the file's ticks) of the last event of track data "d" that
+  # MidiParser would return, or None if there isn't one, and its first time
+  # signature or None. The same as decoding the track, but without making events.
+  parser = MidiParser()
+  total_time = 0
+  last_time = None
+  time_sig = None
+  for (c, evt, p, n) in midifile_iter_tokens(d):
+    total_time += c
+    hi = evt&0xF0
+    if hi == 0xD0:
+      # Channel pressure isn't returned
+      continue
+    if hi == 0xB0 and d[p] in _RPN_CONTROLLERS:
+      if parser.decode(d, evt, p) is None:
+        # Part of an RPN
+        continue
+    elif evt == 0xFF and d[p] == 0x58 and d[p+1] == 4:
+      if time_sig is None and d[p+2] != 0:
+        time_sig = (d[p+2], d[p+3])
+    last_time = total_time
+  return (last_time, time_sig)
+
+
+# The functions below are kept for existing callers. Each call of process_track() or
+# midifile_read() uses a new MidiParser, so they are safe to use from several
+# threads. consume_midi_event() and clear_midi_events() share one MidiParser
+# between calls, as they always have, so are not.
+
+_parser = MidiParser()
+
+def clear_midi_events():
+  _parser.clear_midi_events()
+
+def consume_midi_event(b, pos):
+  return _parser.consume_midi_event(b, pos)
+
+def process_track(b, division):
+  return MidiParser().process_track(b, division)
+
+def midifile_read(b, channels=None, kinds=None):
+  # "channels" and "kinds" optionally restrict which events are returned; see
+  # MidiParser
+  return MidiParser(channels, kinds).read(b)
+
+
+class ChannelIndex:
+  # An index of which tracks of a parsed MIDI file (as returned by midifile_read)
+  # hold which MIDI channels. Built in a single scan of the file, after which
+  # looking up a channel doesn't depend on the length of the file.
+  #
+  #   note_tracks     Dictionary of channel (1-16) -> number of the first track with
+  #                   a note_on event on that channel
+  #   ranges          Dictionary of channel (1-16) -> list of (track number, first
+  #                   event number, last event number) for every track with events
+  #                   on that channel. Event numbers are indexes into the track, and
+  #                   "last" is inclusive
+  #   streams         Dictionary of channel (1-16) -> list of events, for channels
+  #                   whose notes are in a track shared with events of other
+  #                   channels (e.g. a Type 0 file). See midifile_demux()
+  
+  def __init__(self, trks):
+    self.note_tracks = {}
+    self.ranges = {}
+    self.streams = {}
+    for (t, trk) in enumerate(trks):
+      first = {}
+      last = {}
+      note_chs = set()
+      for (i, evt) in enumerate(trk):
+        ch = evt.channel
+        if ch is None:
+          continue
+        if ch not in first:
+          first[ch] = i
+        last[ch] = i
+        if evt.type == NOTE_ON:
+          note_chs.add(ch)
+      for ch in first:
+        self.ranges.setdefault(ch, []).append((t, first[ch], last[ch]))
+      new_chs = [ch for ch in note_chs if ch not in self.note_tracks]
+      for ch in new_chs:
+        self.note_tracks[ch] = t
+      if len(first) > 1 and new_chs:
+        # Events of several channels in one track, so split it up
+        demuxed = midifile_demux(trk)
+        for ch in new_chs:
+          self.streams[ch] = demuxed[ch]
+
+  def events_for(self, trks, ch):
+    # Returns the events for channel "ch" from "trks" (the tracks this index was
+    # made from): those of the track holding its notes which are on channel "ch" or
+    # have no channel. None if there are no notes on "ch".
+    x = self.streams.get(ch, None)
+    if x is not None:
+      return x
+    t = self.note_tracks.get(ch, None)
+    if t is None:
+      return None
+    return trks[t]
 
 
 
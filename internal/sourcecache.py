@@ -0,0 +1,308 @@
+##
+#
+# A cache of the source files read while making an AC7 rhythm. A rhythm typically
+# refers to the same few MIDI files from many of its tracks, and each of them would
+# otherwise be read and parsed again for every element and part that uses it.
+#
+# Parsed MIDI data is keyed by a hash of the file contents, so two paths holding the
+# same bytes share one parse. The cache is normally valid for a single build, but if
+# a cache directory is given the parsed data is also stored there (one file per
+# source file) and re-used by later builds.
+#
+# The files in the cache directory are in a compact binary format, which is mapped
+# into memory to be read:
+#
+#   Header          MIDICACHE_HEADER: magic 'AC7P', CACHE_VERSION, size & mtime (in
+#                   ns) of the source file, SHA-1 of its contents, its length in
+#                   ticks, the numerator & log-denominator of its first time
+#                   signature (0, 0 if none), length of the source path and number
+#                   of tracks
+#   Path            The source path (UTF-8)
+#   Track lengths   Number of events in each track (4 bytes each)
+#   Events          One MIDICACHE_RECORD for every event of every track: time in
+#                   ticks, type code, channel (0 if none) and two data values
+#
+# A file is used as it is if the size & mtime of the source file haven't changed;
+# otherwise, if the contents haven't changed either, only the header is updated.
+# This means the source file doesn't even need to be read for a build to know it's
+# unchanged.
+#
+#
+## Classes:
+#
+#   SourceCache(cache_dir=None)
+#   ===========================
+#
+#   cache_dir:      <Optional> a directory in which to keep parsed MIDI data between
+#                   builds. It is created if it doesn't exist. If None, nothing is
+#                   written to disk.
+#
+# Methods:
+#
+#   file_hash(path)     Returns the content hash (a hex string) of a source file.
+#                       Worked out at most once per file per cache.
+#
+#   midi(path, channels=None, kinds=None)
+#                       Returns the file as parsed by
+#                       internal.midifiles.midifile_read(), optionally only with
+#                       the given channels and kinds of event. Each distinct file
+#                       content is parsed at most once per cache for each
+#                       "channels" & "kinds".
+#
+#   midi_summary(path)  Returns internal.midifiles.midifile_summary() of the file,
+#                       i.e. its length and time signature. If the file hasn't
+#                       been parsed yet, this is worked out from the tokens of
+#                       the file without decoding its events, or read from the
+#                       cache directory.
+#
+#   midi_index(path, channels=None, kinds=None)
+#                       Returns an internal.midifiles.ChannelIndex for the parsed
+#                       file. Each is built at most once per cache.
+#
+#   parsed(path, parse) Returns parse(d), where "d" is the contents of the file.
+#                       For any other type of source file, e.g. tone files. Each
+#                       distinct file content is parsed at most once per cache and
+#                       "parse" function. Results are not stored on disk.
+#
+# Example:
+#
+#    cache = SourceCache()
+#    trks = cache.midi("examples/ex1-v1.mid")
+#    trks = cache.midi("examples/ex1-v1.mid")   # <-- doesn't read the file again
+#
+
+import contextlib
+import hashlib
+import mmap
+import os
+import os.path
+import struct
+
+import internal.midifiles
+
+
+# Version of the parsed data stored in the cache directory. Change this whenever
+# the output of the MIDI parser changes.
+CACHE_VERSION = 4
+
+# Layout of the files in the cache directory, see above
+MIDICACHE_MAGIC = b'AC7P'
+MIDICACHE_HEADER = struct.Struct('<4sHQq20sIBBHI')
+MIDICACHE_RECORD = struct.Struct('<IBBih')
+
+
+def midicache_header(fn):
+  # Returns the header of cache file "fn" as a tuple (source path, size, mtime,
+  # hash, max time, time signature), or None if it doesn't exist or isn't in the
+  # current format
+  try:
+    with open(fn, "rb") as f:
+      d = f.read(MIDICACHE_HEADER.size)
+      if len(d) < MIDICACHE_HEADER.size:
+        return None
+      (magic, version, size, mtime, h, max_time, ts_num, ts_logden, n, num_tracks) = MIDICACHE_HEADER.unpack(d)
+      if magic != MIDICACHE_MAGIC or version != CACHE_VERSION:
+        return None
+      path = f.read(n).decode('utf-8')
+  except (OSError, UnicodeDecodeError):
+    return None
+  if ts_num == 0:
+    time_sig = None
+  else:
+    time_sig = (ts_num, ts_logden)
+  return (path, size, mtime, h.hex(), max_time, time_sig)
+
+
+def midicache_write(fn, path, st, h, trks):
+  # Write the parsed tracks "trks" of source file "path", whose os.stat() result is
+  # "st" and content hash "h", to cache file "fn"
+  (max_time, time_sig) = internal.midifiles.midifile_summary(trks)
+  if time_sig is None:
+    time_sig = (0, 0)
+  p = path.encode('utf-8')
+  b = bytearray(MIDICACHE_HEADER.pack(MIDICACHE_MAGIC, CACHE_VERSION, st.st_size, st.st_mtime_ns, bytes.fromhex(h),
+                                      max_time, time_sig[0], time_sig[1], len(p), len(trks)))
+  b += p
+  b += struct.pack('<{0}I'.format(len(trks)), *[len(trk) for trk in trks])
+  pack = MIDICACHE_RECORD.pack
+  for trk in trks:
+    for evt in trk:
+      d1 = evt.data1
+      if not isinstance(d1, int):
+        # None, or the (empty) data of metadata & sysex events
+        d1 = 0
+      b += pack(evt.time, evt.type, evt.channel or 0, d1, evt.data2 or 0)
+  # Write to a temporary file first, so that an interrupted build can't leave a
+  # half-written entry behind.
+  tmp_name = fn + ".{0}.tmp".format(os.getpid())
+  with open(tmp_name, "wb") as f:
+    f.write(b)
+  os.replace(tmp_name, fn)
+
+
+def midicache_update(fn, st):
+  # Change the size & mtime in the header of cache file "fn" to those of "st"
+  with open(fn, "r+b") as f:
+    f.seek(6)
+    f.write(struct.pack('<Qq', st.st_size, st.st_mtime_ns))
+
+
+def midicache_read(fn, channels=None, kinds=None):
+  # Read the tracks from cache file "fn", the same as they were written except for
+  # leaving out any events not on "channels" (events without a channel are always
+  # kept) or not of "kinds"
+  MidiEvent = internal.midifiles.MidiEvent
+  # Number of data values of each type of event; metadata & sysex events have
+  # their (empty) data as bytes
+  num_fields = [len(x) for x in internal.midifiles.EVENT_FIELDS]
+  num_fields[internal.midifiles.METADATA] = -1
+  num_fields[internal.midifiles.SYSEX] = -1
+  # Which channels (0 = events without a channel) and types of event to keep
+  want_channel = [channels is None or ch == 0 or ch in channels for ch in range(17)]
+  want_kind = [kinds is None or k in kinds for k in range(len(num_fields))]
+  with open(fn, "rb") as f:
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  with contextlib.closing(mm):
+    n = MIDICACHE_HEADER.unpack_from(mm, 0)[8]
+    pos = MIDICACHE_HEADER.size + n
+    num_tracks = MIDICACHE_HEADER.unpack_from(mm, 0)[9]
+    lengths = struct.unpack_from('<{0}I'.format(num_tracks), mm, pos)
+    pos += 4*num_tracks
+    trks = []
+    for x in lengths:
+      trk = []
+      append = trk.append
+      end = pos + x*MIDICACHE_RECORD.size
+      if end > len(mm):
+        raise Exception("Cache file '{0}' is truncated".format(fn))
+      with memoryview(mm)[pos:end] as mv:
+        records = list(MIDICACHE_RECORD.iter_unpack(mv))
+      for (t, typ, ch, d1, d2) in records:
+        if not (want_channel[ch] and want_kind[typ]):
+          continue
+        k = num_fields[typ]
+        if k == 2:
+          append(MidiEvent(typ, ch or None, d1, d2, t))
+        elif k == 1:
+          append(MidiEvent(typ, ch or None, d1, None, t))
+        elif k == 0:
+          append(MidiEvent(typ, ch or None, None, None, t))
+        else:
+          append(MidiEvent(typ, ch or None, b'', None, t))
+      trks.append(trk)
+      pos = end
+  return trks
+
+
+class SourceCache:
+
+  def __init__(self, cache_dir=None):
+    self.cache_dir = cache_dir
+    self._hashes = {}    # Content hash of each file, by path
+    self._parsed = {}    # Parsed MIDI data, by content hash, channels & kinds
+    self._indexes = {}   # Channel indexes of the parsed MIDI data, likewise
+    self._summaries = {} # Length & time signature of MIDI data, by content hash
+    self._others = {}    # Other parsed data, by content hash & parse function
+    self._headers = {}   # Headers of the files in the cache directory, by path
+
+  def _disk_path(self, path):
+    # The cache file for source file "path". The version is part of the name so
+    # that data from an older parser is never picked up.
+    h = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+    return os.path.join(self.cache_dir, "{0}.v{1}.midc".format(h, CACHE_VERSION))
+
+  def _disk_header(self, path):
+    # The header of the cache file for "path", if it's up to date
+    if self.cache_dir is None:
+      return None
+    if path not in self._headers:
+      hdr = midicache_header(self._disk_path(path))
+      if hdr is not None:
+        st = os.stat(path)
+        if hdr[0] != os.path.abspath(path):
+          hdr = None
+        elif hdr[1] != st.st_size or hdr[2] != st.st_mtime_ns:
+          # The file has been touched. It can still be used if the contents
+          # are the same
+          if hdr[3] == self._hash_contents(path):
+            midicache_update(self._disk_path(path), st)
+          else:
+            hdr = None
+      self._headers[path] = hdr
+    return self._headers[path]
+
+  def _hash_contents(self, path):
+    # Files are mapped into memory rather than read, so they never need to be
+    # held in memory as a whole
+    with internal.midifiles.midifile_map(path) as b:
+      return hashlib.sha1(b).hexdigest()
+
+  def file_hash(self, path):
+    if path not in self._hashes:
+      hdr = self._disk_header(path)
+      if hdr is not None:
+        # Known from the cache directory, without reading the file
+        self._hashes[path] = hdr[3]
+      else:
+        self._hashes[path] = self._hash_contents(path)
+    return self._hashes[path]
+
+  def _key(self, path, channels, kinds):
+    # Key for parsed data, from the content hash and the parse filter
+    if channels is not None:
+      channels = tuple(sorted(channels))
+    if kinds is not None:
+      kinds = tuple(sorted(kinds))
+    return (self.file_hash(path), channels, kinds)
+
+  def midi(self, path, channels=None, kinds=None):
+    key = self._key(path, channels, kinds)
+    trks = self._parsed.get(key, None)
+    if trks is None:
+      if self._disk_header(path) is not None:
+        trks = midicache_read(self._disk_path(path), channels, kinds)
+      elif self.cache_dir is not None:
+        # The whole file is parsed for the cache directory, since other builds
+        # may want other channels
+        all_trks = internal.midifiles.midifile_load(path)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        midicache_write(self._disk_path(path), os.path.abspath(path), os.stat(path), key[0], all_trks)
+        self._headers.pop(path, None)
+        self._parsed[(key[0], None, None)] = all_trks
+        trks = [[evt for evt in trk if (evt.channel is None or channels is None or evt.channel in channels) and (kinds is None or evt.type in kinds)] for trk in all_trks]
+      else:
+        trks = internal.midifiles.midifile_load(path, channels, kinds)
+      self._parsed[key] = trks
+    return trks
+
+  def midi_summary(self, path):
+    h = self.file_hash(path)
+    x = self._summaries.get(h, None)
+    if x is None:
+      hdr = self._disk_header(path)
+      if hdr is not None:
+        x = (hdr[4], hdr[5])
+      elif (h, None, None) in self._parsed:
+        x = internal.midifiles.midifile_summary(self._parsed[(h, None, None)])
+      else:
+        with internal.midifiles.midifile_map(path) as b:
+          x = internal.midifiles.midifile_summary(b)
+      self._summaries[h] = x
+    return x
+
+  def midi_index(self, path, channels=None, kinds=None):
+    key = self._key(path, channels, kinds)
+    idx = self._indexes.get(key, None)
+    if idx is None:
+      idx = internal.midifiles.ChannelIndex(self.midi(path, channels, kinds))
+      self._indexes[key] = idx
+    return idx
+
+  def parsed(self, path, parse):
+    h = self.file_hash(path)
+    x = self._others.get((h, parse), None)
+    if x is None:
+      with open(path, "rb") as f:
+        x = parse(f.read())
+      self._others[(h, parse)] = x
+    return x
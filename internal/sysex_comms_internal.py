@@ -24,6 +24,16 @@
 #                   depend on category and memory, in the case of user rhythms it
 #                   is 0-49 inclusive
 #   data:           Byte array of HBR data to write
+#   window:         <Optional> most HBS packets to send before they've been ACKed.
+#                   Default is 1, i.e. wait for the ACK of each packet before
+#                   sending the next. See SysexSession.send_pipelined()
+#   chunk_size:     <Optional> bytes of data in each HBS packet. Default is 0x80.
+#                   If 0, the largest size the keyboard takes is found out and
+#                   used; see SysexSession.probe_chunk_size()
+#
+# If a packet isn't ACKed, or the keyboard says it's busy while several packets are
+# in flight, the upload is started again from the beginning, waiting for the ACK of
+# each packet and with 0x80 bytes in each, up to UPLOAD_RETRIES times.
 #
 # Example:
 #
@@ -101,6 +111,46 @@
 #
 #
 #
+## Classes:
+#
+#   SysexSession(fd=None, fs=None)
+#   ==============================
+#
+# A connection to one keyboard, which holds all the state of the communications
+# with it. The functions above each make a new session for the one call; to talk
+# to more than one keyboard at once (e.g. from separate threads), or to make many
+# calls on the same connection, use a session for each keyboard. "fd" and "fs" are
+# as in Common Parameters, below. A device opened by the session is closed by
+# close(), or at the end of a "with" block.
+#
+# Methods:
+#
+#   upload_ac7(param_set, data, ...)          As upload_ac7_internal()
+#   send_pipelined(pkts, window=MAX_WINDOW)   Send packets that are each ACKed,
+#                                             several at a time. Returns whether
+#                                             all were ACKed
+#   send_acked(pkts)                          Send packets one at a time, waiting
+#                                             for the ACK of each. Returns whether
+#                                             all were ACKed
+#   probe_chunk_size(param_set, data, category, memory)
+#                                             Send the first HBS packet of an
+#                                             upload as large as the keyboard
+#                                             will take
+#   forget_chunk_size(category, memory)       Forget the size found by
+#                                             probe_chunk_size()
+#   download_ac7(param_set, ...)              As download_ac7_internal()
+#   set_single_parameter(parameter, data, ...)
+#   get_single_parameter(parameter, ...)
+#   close()
+#
+# Example:
+#
+#    with SysexSession('/dev/midi2') as s:
+#      s.set_single_parameter(43, 5)
+#      print(s.get_single_parameter(43))
+#
+#
+#
 #   Common Parameters
 #   =================
 #
@@ -133,15 +183,18 @@
 import time
 import os
 import os.path
+import re
 import struct
 import sys
 import binascii
+import select
 import shelve
+import threading
 
 
 
-from internal.midi7bit import midi_7bit_to_8bit
 from internal.midi7bit import midi_8bit_to_7bit
+from internal.midi7bit import Midi7BitDecoder
 
 
 # Define the Linux device name. Assumes this is the only MIDI connection
@@ -154,117 +207,55 @@ DEVICE_NAME = "/dev/midi1"
 #
 DEVICE_ID = b"\x44\x19\x01\x7F"
 
+# How long to wait for an ACK from the keyboard, in seconds
+ACK_TIMEOUT = 4.0
 
+# In a pipelined upload: the longest to wait for the keyboard to ACK anything
+# before giving up on the upload, and the most packets to have sent without an ACK
+RETRANSMIT_TIMEOUT = 1.0
+MAX_WINDOW = 8
 
+# HBS packets don't say where their data goes, so once a packet or its ACK may
+# have been lost there's no telling which packet to send next. The upload is
+# started again instead, up to this many times
+UPLOAD_RETRIES = 5
 
+# When waiting for the ACK of each packet in turn, and the keyboard says it's busy:
+# how long to wait before sending the packet again. This doubles each time, up to
+# RETRANSMIT_TIMEOUT, until the packet has been busy for ACK_TIMEOUT
+BUSY_BACKOFF = 0.05
 
+# Payload size of HBS packets. Larger ones can be used if the keyboard takes them:
+# uploads with chunk_size=0 try each of PROBE_CHUNK_SIZES in turn on the first
+# packet, going on to the next if the keyboard says it's busy, and use the first
+# that is ACKed. The result is kept in CHUNK_SIZE_DB for each model (as given in
+# the keyboard's replies) & location, so it's only worked out once.
+CHUNK_SIZE = 0x80
+PROBE_CHUNK_SIZES = [0x800, 0x400, 0x200, 0x100]
+CHUNK_SIZE_DB = os.path.join(os.path.dirname(__file__), "hbs_chunk_sizes.shelve")
 
-is_busy = False
-must_send_ack = False
-have_got_ack = False
-have_got_ess = False
+# Most bytes to take from the device at once. Reads return as soon as anything is
+# there, so this only needs to be enough for a few packets
+READ_SIZE = 1024
 
-so_far = b''
+# System realtime messages (e.g. MIDI clock, active sensing) may turn up anywhere,
+# even inside a sysex packet, and are ignored
+_REALTIME = bytes(range(0xF8, 0x100))
 
-total_rxed = b''
+# Any status byte, i.e. the end of the data of a sysex packet
+_STATUS_BYTE = re.compile(b'[\x80-\xff]')
 
-type_1_rxed = b''
+# The databases of parameter lengths (see set_single_parameter) and chunk sizes
+# can't be opened by two sessions at once
+_shelve_lock = threading.Lock()
 
-def handle_pkt(p):
-  global is_busy
-  global must_send_ack
-  global have_got_ack
-  global have_got_ess
-  global total_rxed
-  global type_1_rxed
-  if len(p) < 7:
-    print("BAD PACKET!!")
-    return
-  if p[0] != 0xF0 or p[1] != 0x44 or p[4] != 0x7F or p[-1] != 0xF7:
-    print("BAD PACKET!!")
-    return
-  type_of_pkt = p[5]
-  if type_of_pkt == 0xB:
-    is_busy = True
-  else:
-    is_busy = False
-    if type_of_pkt == 0xA:
-      have_got_ack = True
-    if type_of_pkt == 0xD:
-      have_got_ack = True
-      have_got_ess = True
-      
-      
-  if type_of_pkt == 3 or type_of_pkt == 5:   # This takes a CRC
-    c = struct.unpack('<5B', p[-6:-1])
-    crc_compare = c[0] + (1<<7)*c[1] + (1<<14)*c[2] + (1<<21)*c[3] + (1<<28)*c[4]
-    if binascii.crc32(p[1:-6]) == crc_compare:
-      must_send_ack = True
-      if type_of_pkt == 5:
-        have_got_ack = True # This one must look like an ACK
-        mm = midi_7bit_to_8bit(p[12:-6])
-        total_rxed += mm
-    else:
-      print("BAD CRC!!!")
 
 
-  if type_of_pkt == 1:
-    v = p[24:-1]
-    type_1_rxed = v
 
 
-def parse_response(b, *, _debug=False):
-  global so_far
-  
-  in_pkt = True
-  if len(so_far) == 0:
-    in_pkt = False
-  
-  for i in range(len(b)):
-    x = b[i]
-    if in_pkt:
-      if x == 0xF7:
-        so_far += b'\xf7'
-        # Have completed. Do something!
-        if _debug:
-          print(so_far.hex(" ").upper())
-        handle_pkt(so_far)
-        in_pkt = False
-        so_far = b''
-      elif x == 0xF0:
-        # Error! but start a new packet
-        so_far = b'\xf0'
-      elif x >= 0x80:
-        # Error!
-        in_pkt = False
-        so_far = b''
-      else:
-        so_far += b[i:i+1]
-    else:
-      if x == 0xF0:
-        so_far = b'\xf0'
-        in_pkt = True
-
 class SysexTimeoutError(Exception):
   pass
 
-def wait_for_ack(f):
-  global have_got_ack
-  have_got_ack = False
-  st = time.monotonic()
-  while True:
-    parse_response(os.read(f, 20))
-    if have_got_ack:
-      # Success!
-      return
-    time.sleep(0.02)
-    if time.monotonic() > st + 4.0:
-      # Clean up. We're exiting with an exception, but just in case a higher-
-      # level process catches the exception we should have the port closed.
-      os.close(f)
-      # Timed out. Completely exit the program
-      raise SysexTimeoutError("SYSEX communication timed out. Exiting ...")
-
 
 def make_packet(tx=False,
                 category=30,
@@ -323,306 +314,590 @@ def make_packet(tx=False,
 
 
 
-def set_single_parameter(parameter, data, category=3, memory=3, parameter_set=0, block0=0, block1=0, *, fd=None, fs=None, _debug=False):
-
-  global type_1_rxed
+class SysexSession:
+  # A connection to one keyboard, holding the state of the protocol: the packet
+  # being received, whether an ACK has been received, and the data received so
+  # far. Separate sessions (e.g. one per device, in different threads) don't share
+  # any state.
 
-  if fd is None:
-    fd = DEVICE_NAME
-
-  # Open the device (if needed)
-  if fs is None:
-    f = os.open(fd, os.O_RDWR)
-  else:
-    f = fs
-
-
-  # Flush the input queue
-  parse_response(os.read(f, 20))
-  time.sleep(0.4)
-
-  # Prepare the input
-  d = b''
-  l = 1
-
-  if isinstance(data, type(0)):
-    # The input is an integer. The "length" parameter passed to make_packet must be
-    # 1, but we don't know how many bytes of bit-stuffed data the keyboard is actually
-    # expecting. Read the current value to find that out.
-    #
-    # The values are cached in a shelving database to speed things up. Reading out
-    # is quite a slow operation, so we want to do it as little as possible.
-    
-    
-    KEY= f"{category:d},{parameter:d}"
-    SHELVE_DB = os.path.join(os.path.dirname(__file__), "ctx_parameter_lengths.shelve")
-    key_len = None
-    
-    with shelve.open(SHELVE_DB) as db:
-      if KEY in db.keys():
-        key_len = db[KEY]
-    
-    if key_len is None:
-      type_1_rxed = b''
-
-      # Read the current parameter value
-      os.write(f, make_packet(parameter_set=parameter_set, category=category, memory=memory, parameter=parameter, block=[0,0,block1,block0], length=1))
-      time.sleep(0.1)
-      
-      # Handle any response
-      parse_response(os.read(f, 20))
-      time.sleep(0.2)
-      parse_response(os.read(f, 20))
-      time.sleep(0.01)
-      
-      if len(type_1_rxed)<1 or len(type_1_rxed)>5:
-        os.close(f)
-        raise SysexTimeoutError("Not able to read out value to write")
-      else:
-        key_len = len(type_1_rxed)
+  def __init__(self, fd=None, fs=None):
+    if fs is None:
+      if fd is None:
+        fd = DEVICE_NAME
+      # Open the device
+      self.f = os.open(fd, os.O_RDWR)
+      self._own_f = True
+    else:
+      self.f = fs
+      self._own_f = False
+    self._poll = select.poll()
+    self._poll.register(self.f, select.POLLIN)
+
+    self.is_busy = False
+    self.must_send_ack = False
+    self.have_got_ack = False
+    self.have_got_ess = False
+    self.acks_rxed = 0         # Number of ACK packets received
+    self.busy_rxed = 0         # Number of busy packets received
+    self.model_id = None       # Model ID (2 bytes) of the keyboard, from its replies
+    self.so_far = bytearray()  # Start of a packet not yet complete
+    # Decodes the data of type 5 packets as they arrive
+    self.rx_decoder = Midi7BitDecoder()
+    self.type_1_rxed = b''
+
+  def close(self):
+    # Close the device, if it was opened by this session
+    if self._own_f and self.f is not None:
+      os.close(self.f)
+    self.f = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def _abort(self):
+    # Close the device, even if it wasn't opened by this session. We're exiting
+    # with an exception, but just in case a higher-level process catches the
+    # exception we should have the port closed.
+    if self.f is not None:
+      os.close(self.f)
+    self.f = None
+
+  def handle_pkt(self, p):
+    if len(p) < 7:
+      print("BAD PACKET!!")
+      return
+    if p[0] != 0xF0 or p[1] != 0x44 or p[4] != 0x7F or p[-1] != 0xF7:
+      print("BAD PACKET!!")
+      return
+    self.model_id = p[2:4]
+    type_of_pkt = p[5]
+    if type_of_pkt == 0xB:
+      self.is_busy = True
+      self.busy_rxed += 1
+    else:
+      self.is_busy = False
+      if type_of_pkt == 0xA:
+        self.have_got_ack = True
+        self.acks_rxed += 1
+      if type_of_pkt == 0xD:
+        self.have_got_ack = True
+        self.have_got_ess = True
         
-        with shelve.open(SHELVE_DB) as db:
-          db[KEY] = key_len
-    
-    
-    # Now do the bit-stuffing
-    for i in range(key_len):
-      d = d + struct.pack('B', data&0x7F)
-      data = data//0x80
-    l = 1   # length is always 1 for numeric inputs
-
-  else:
-    # Assume the input is a byte array
-    d = data
-    l = len(d)
-  
-
-  # Write the parameter
-  os.write(f, make_packet(tx=True, parameter_set=parameter_set, category=category, memory=memory, parameter=parameter, block=[0,0,block1,block0], length=l, data=d))
-  time.sleep(0.1)
-  
-  # Handle any response -- don't expect one
-  parse_response(os.read(f, 20))
-  time.sleep(0.01)
-
-  # Close the device
-  if fs is None:
-    os.close(f)
-
-
-
-
-
-def get_single_parameter(parameter, category=3, memory=3, parameter_set=0, block0=0, block1=0, length=0, *, fd=None, fs=None, _debug=False):
-
-  global type_1_rxed
-
-  if fd is None:
-    fd = DEVICE_NAME
-
-  # Open the device (if needed)
-  if fs is None:
-    f = os.open(fd, os.O_RDWR)
-  else:
-    f = fs
+        
+    if type_of_pkt == 3 or type_of_pkt == 5:   # This takes a CRC
+      c = struct.unpack('<5B', p[-6:-1])
+      crc_compare = c[0] + (1<<7)*c[1] + (1<<14)*c[2] + (1<<21)*c[3] + (1<<28)*c[4]
+      if binascii.crc32(p[1:-6]) == crc_compare:
+        self.must_send_ack = True
+        if type_of_pkt == 5:
+          self.have_got_ack = True # This one must look like an ACK
+          self.rx_decoder.write(p[12:-6])
+          self.rx_decoder.flush()
+      else:
+        print("BAD CRC!!!")
 
 
-  # Flush the input queue
-  parse_response(os.read(f, 20))
-  time.sleep(0.4)
-  
-  if length>0:
-    l = length
-  else:
-    l = 1
-  
-  
-  type_1_rxed = b''
+    if type_of_pkt == 1:
+      v = p[24:-1]
+      self.type_1_rxed = v
 
-  # Read the parameter
-  os.write(f, make_packet(parameter_set=parameter_set, category=category, memory=memory, parameter=parameter, block=[0,0,block1,block0], length=l))
-  time.sleep(0.1)
-  
-  # Handle any response
-  parse_response(os.read(f, 20), _debug=_debug)
-  time.sleep(0.2)
-  parse_response(os.read(f, 20), _debug=_debug)
-  time.sleep(0.01)
-
-  # Close the device
-  if fs is None:
-    os.close(f)
-  
-  
-  # Now decode the response. Value of "length" determines whether to regard it as
-  # a string or a number
-  if length > 0:
-    # Regard the response as a string
-    if len(type_1_rxed)>0:   # should maybe check this is equal to length??
-      return type_1_rxed
+  def parse_response(self, b, *, _debug=False):
+    # Cut the complete packets out of the data received so far, & handle them. A
+    # packet runs from an 0xF0 byte to the next status byte: if that's 0xF7 it's
+    # complete, if it's 0xF0 it's an error but a new packet starts, and any other
+    # status byte is an error.
+    buf = self.so_far + bytes(b).translate(None, _REALTIME)
+    if len(self.so_far) > 0:
+      pos = 0
     else:
-      return b''   # Error! Nothing read
-  else:
-    # Regard the response as a number
-    f = -1
-    if len(type_1_rxed)>0:
-      # A number has been received. Decode it.
-      if len(type_1_rxed) == 1:
-        f = struct.unpack('<B', type_1_rxed)[0]
-      elif len(type_1_rxed) == 2:
-        g = struct.unpack('<2B', type_1_rxed)
-        if g[0] >= 128 or g[1] >= 128:
-          raise Exception("Invalid packed value")
-        f = g[0] + 128*g[1]
-      elif len(type_1_rxed) == 3:
-        g = struct.unpack('<3B', type_1_rxed)
-        if g[0] >= 128 or g[1] >= 128 or g[2] >= 128:
-          raise Exception("Invalid packed value")
-        f = g[0] + 128*g[1] + 128*128*g[2]
-      elif len(type_1_rxed) == 4:
-        g = struct.unpack('<4B', type_1_rxed)
-        if g[0] >= 128 or g[1] >= 128 or g[2] >= 128  or g[3] >= 128:
-          raise Exception("Invalid packed value")
-        f = g[0] + 128*g[1] + 128*128*g[2] + 128*128*128*g[3]
-      elif len(type_1_rxed) == 5:
-        g = struct.unpack('<5B', type_1_rxed)
-        if g[0] >= 128 or g[1] >= 128 or g[2] >= 128  or g[3] >= 128 or g[4] >= 16:
-          raise Exception("Invalid packed value")
-        f = g[0] + 128*g[1] + 128*128*g[2] + 128*128*128*g[3] + 128*128*128*128*g[4]
+      pos = buf.find(0xF0)
+    while pos >= 0:
+      m = _STATUS_BYTE.search(buf, pos+1)
+      if m is None:
+        # Not complete yet
+        self.so_far = buf[pos:]
+        return
+      j = m.start()
+      if buf[j] == 0xF7:
+        # Have completed. Do something!
+        pkt = bytes(buf[pos:j+1])
+        if _debug:
+          print(pkt.hex(" ").upper())
+        self.handle_pkt(pkt)
+        pos = buf.find(0xF0, j+1)
+      elif buf[j] == 0xF0:
+        # Error! but start a new packet
+        pos = j
       else:
-        #raise Exception("Too long to be a number")
-        pass
-    return f
-
-
-
-
-
-
-def upload_ac7_internal(param_set, data, memory=1, category=30, *, fd=None, fs=None, _debug=False):
-
-  if fd is None:
-    fd = DEVICE_NAME
+        # Error!
+        pos = buf.find(0xF0, j+1)
+    self.so_far = bytearray()
+
+  def read_response(self, _debug=False):
+    # Read and handle whatever the keyboard has sent
+    self.parse_response(os.read(self.f, READ_SIZE), _debug=_debug)
+
+  def wait_for_ack(self):
+    # Handle data from the keyboard as soon as it arrives, until there's an ACK
+    self.have_got_ack = False
+    deadline = time.monotonic() + ACK_TIMEOUT
+    while True:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        self._abort()
+        # Timed out. Completely exit the program
+        raise SysexTimeoutError("SYSEX communication timed out. Exiting ...")
+      if self._poll.poll(remaining*1000.0):
+        self.read_response()
+        if self.have_got_ack:
+          # Success!
+          return
+
+  def wait_for_reply(self, timeout):
+    # Handle data from the keyboard as soon as it arrives, until there's an ACK or
+    # a busy packet, or "timeout" seconds have passed. Returns whether there was an
+    # ACK
+    self.have_got_ack = False
+    self.busy_rxed = 0
+    deadline = time.monotonic() + timeout
+    while True:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        return False
+      if self._poll.poll(remaining*1000.0):
+        self.read_response()
+        if self.have_got_ack:
+          return True
+        if self.busy_rxed > 0:
+          return False
+
+  def drain(self):
+    # Handle whatever the keyboard still has to say about packets that have been
+    # given up on (e.g. late ACKs), until it hasn't sent an ACK or busy packet for
+    # RETRANSMIT_TIMEOUT
+    self.acks_rxed = 0
+    self.busy_rxed = 0
+    deadline = time.monotonic() + RETRANSMIT_TIMEOUT
+    while True:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        return
+      if self._poll.poll(remaining*1000.0):
+        self.read_response()
+        if self.acks_rxed > 0 or self.busy_rxed > 0:
+          self.acks_rxed = 0
+          self.busy_rxed = 0
+          deadline = time.monotonic() + RETRANSMIT_TIMEOUT
+
+  def _chunk_size_key(self, category, memory):
+    # Key for the chunk size of the keyboard's model & a location in CHUNK_SIZE_DB
+    model_id = self.model_id
+    if model_id is None:
+      model_id = DEVICE_ID[1:3]
+    return "{0},{1:d},{2:d}".format(model_id.hex(), category, memory)
+
+  def forget_chunk_size(self, category, memory):
+    # Remove the chunk size of a location from CHUNK_SIZE_DB, so that it's found
+    # out again next time
+    with _shelve_lock, shelve.open(CHUNK_SIZE_DB) as db:
+      db.pop(self._chunk_size_key(category, memory), None)
+
+  def probe_chunk_size(self, param_set, data, category, memory):
+    # Send the first HBS packet of "data" as large as the keyboard will take, and
+    # return the size used. The size is looked up in CHUNK_SIZE_DB, or else found
+    # by trying each of PROBE_CHUNK_SIZES (and the smaller ones if the size looked
+    # up isn't taken any more). A size is too large if the keyboard says it's busy;
+    # if it doesn't take any of them, CHUNK_SIZE is used. Returns None if the
+    # keyboard doesn't answer at all, as there's then no telling whether it took
+    # the packet.
+    key = self._chunk_size_key(category, memory)
+    with _shelve_lock, shelve.open(CHUNK_SIZE_DB) as db:
+      known = db.get(key, None)
+    if known is not None:
+      # If it's no longer taken, try the smaller ones
+      sizes = [known] + [x for x in PROBE_CHUNK_SIZES if x < known]
+    else:
+      sizes = PROBE_CHUNK_SIZES
+
+    tried = False
+    for size in sizes:
+      if size <= CHUNK_SIZE or size > len(data):
+        # Nothing to find out from this one
+        continue
+      tried = True
+      os.write(self.f, make_packet(parameter_set=param_set, category=category, memory=memory, command=5, length=size, data=data[0:size]))
+      if self.wait_for_reply(ACK_TIMEOUT):
+        if size != known:
+          with _shelve_lock, shelve.open(CHUNK_SIZE_DB) as db:
+            db[key] = size
+        return size
+      if self.busy_rxed == 0:
+        return None
+
+    # Fall back to the usual size
+    size = min(CHUNK_SIZE, len(data))
+    os.write(self.f, make_packet(parameter_set=param_set, category=category, memory=memory, command=5, length=size, data=data[0:size]))
+    if not self.wait_for_reply(ACK_TIMEOUT):
+      return None
+    if tried:
+      with _shelve_lock, shelve.open(CHUNK_SIZE_DB) as db:
+        db[key] = CHUNK_SIZE
+    return CHUNK_SIZE
+
+  def set_single_parameter(self, parameter, data, category=3, memory=3, parameter_set=0, block0=0, block1=0, *, _debug=False):
+
+    f = self.f
+
+    # Flush the input queue
+    self.read_response()
+    time.sleep(0.4)
+
+    # Prepare the input
+    d = b''
+    l = 1
 
-  # Open the device (if needed)
-  if fs is None:
-    f = os.open(fd, os.O_RDWR)
-  else:
-    f = fs
+    if isinstance(data, type(0)):
+      # The input is an integer. The "length" parameter passed to make_packet must be
+      # 1, but we don't know how many bytes of bit-stuffed data the keyboard is actually
+      # expecting. Read the current value to find that out.
+      #
+      # The values are cached in a shelving database to speed things up. Reading out
+      # is quite a slow operation, so we want to do it as little as possible.
+      
+      
+      KEY= f"{category:d},{parameter:d}"
+      SHELVE_DB = os.path.join(os.path.dirname(__file__), "ctx_parameter_lengths.shelve")
+      key_len = None
+      
+      with _shelve_lock, shelve.open(SHELVE_DB) as db:
+        if KEY in db.keys():
+          key_len = db[KEY]
+      
+      if key_len is None:
+        self.type_1_rxed = b''
 
+        # Read the current parameter value
+        os.write(f, make_packet(parameter_set=parameter_set, category=category, memory=memory, parameter=parameter, block=[0,0,block1,block0], length=1))
+        time.sleep(0.1)
+        
+        # Handle any response
+        self.read_response()
+        time.sleep(0.2)
+        self.read_response()
+        time.sleep(0.01)
+        
+        if len(self.type_1_rxed)<1 or len(self.type_1_rxed)>5:
+          self._abort()
+          raise SysexTimeoutError("Not able to read out value to write")
+        else:
+          key_len = len(self.type_1_rxed)
+          
+          with _shelve_lock, shelve.open(SHELVE_DB) as db:
+            db[KEY] = key_len
+      
+      
+      # Now do the bit-stuffing
+      for i in range(key_len):
+        d = d + struct.pack('B', data&0x7F)
+        data = data//0x80
+      l = 1   # length is always 1 for numeric inputs
 
-  # Flush the input queue
-  parse_response(os.read(f, 20))
-  time.sleep(0.4)
+    else:
+      # Assume the input is a byte array
+      d = data
+      l = len(d)
+    
 
+    # Write the parameter
+    os.write(f, make_packet(tx=True, parameter_set=parameter_set, category=category, memory=memory, parameter=parameter, block=[0,0,block1,block0], length=l, data=d))
+    time.sleep(0.1)
+    
+    # Handle any response -- don't expect one
+    self.read_response()
+    time.sleep(0.01)
 
-  # Send the SBS command
-  pkt = make_packet(command = 8, sub_command = 3)
-  #print(pkt)
-  os.write(f, pkt)  # SBS(HBS)
-  wait_for_ack(f)
+  def get_single_parameter(self, parameter, category=3, memory=3, parameter_set=0, block0=0, block1=0, length=0, *, _debug=False):
 
+    f = self.f
 
-  i = 0
-  while i < len(data):
-    # Send a HBS packet:
-    # Category 30 = Rhythms
-    # Parameter set: indicates the specific rhythm
-    # Memory 1 = user rhythm space
+    # Flush the input queue
+    self.read_response()
+    time.sleep(0.4)
     
-    len_remaining = len(data) - i
-    if len_remaining > 0x80:
-      len_remaining = 0x80 
+    if length>0:
+      l = length
+    else:
+      l = 1
     
     
-    pkt = make_packet(parameter_set=param_set, category=category, memory=memory, command=5, length=len_remaining, data = data[i:i+len_remaining])
-    #print(pkt)
-    os.write(f, pkt)
-    wait_for_ack(f)
-    i += len_remaining
+    self.type_1_rxed = b''
 
+    # Read the parameter
+    os.write(f, make_packet(parameter_set=parameter_set, category=category, memory=memory, parameter=parameter, block=[0,0,block1,block0], length=l))
+    time.sleep(0.1)
+    
+    # Handle any response
+    self.read_response(_debug=_debug)
+    time.sleep(0.2)
+    self.read_response(_debug=_debug)
+    time.sleep(0.01)
+    
+    
+    # Now decode the response. Value of "length" determines whether to regard it as
+    # a string or a number
+    type_1_rxed = self.type_1_rxed
+    if length > 0:
+      # Regard the response as a string
+      if len(type_1_rxed)>0:   # should maybe check this is equal to length??
+        return type_1_rxed
+      else:
+        return b''   # Error! Nothing read
+    else:
+      # Regard the response as a number
+      f = -1
+      if len(type_1_rxed)>0:
+        # A number has been received. Decode it.
+        if len(type_1_rxed) == 1:
+          f = struct.unpack('<B', type_1_rxed)[0]
+        elif len(type_1_rxed) == 2:
+          g = struct.unpack('<2B', type_1_rxed)
+          if g[0] >= 128 or g[1] >= 128:
+            raise Exception("Invalid packed value")
+          f = g[0] + 128*g[1]
+        elif len(type_1_rxed) == 3:
+          g = struct.unpack('<3B', type_1_rxed)
+          if g[0] >= 128 or g[1] >= 128 or g[2] >= 128:
+            raise Exception("Invalid packed value")
+          f = g[0] + 128*g[1] + 128*128*g[2]
+        elif len(type_1_rxed) == 4:
+          g = struct.unpack('<4B', type_1_rxed)
+          if g[0] >= 128 or g[1] >= 128 or g[2] >= 128  or g[3] >= 128:
+            raise Exception("Invalid packed value")
+          f = g[0] + 128*g[1] + 128*128*g[2] + 128*128*128*g[3]
+        elif len(type_1_rxed) == 5:
+          g = struct.unpack('<5B', type_1_rxed)
+          if g[0] >= 128 or g[1] >= 128 or g[2] >= 128  or g[3] >= 128 or g[4] >= 16:
+            raise Exception("Invalid packed value")
+          f = g[0] + 128*g[1] + 128*128*g[2] + 128*128*128*g[3] + 128*128*128*128*g[4]
+        else:
+          #raise Exception("Too long to be a number")
+          pass
+      return f
+
+  def send_acked(self, pkts):
+    # Send packets which are each ACKed by the keyboard, waiting for the ACK of
+    # each before sending the next. If the keyboard says it's busy, it hasn't taken
+    # the packet, and as it's the only one in flight it can simply be sent again
+    # after a while (see BUSY_BACKOFF). Returns False as soon as a packet gets no
+    # reply within ACK_TIMEOUT, or has been busy for longer than that, otherwise
+    # True.
+    for pkt in pkts:
+      start = time.monotonic()
+      backoff = BUSY_BACKOFF
+      while True:
+        os.write(self.f, pkt)
+        if self.wait_for_reply(ACK_TIMEOUT):
+          break
+        if self.busy_rxed == 0 or time.monotonic() - start > ACK_TIMEOUT:
+          return False
+        time.sleep(backoff)
+        backoff = min(2*backoff, RETRANSMIT_TIMEOUT)
+    return True
+
+  def send_pipelined(self, pkts, window=MAX_WINDOW):
+    # Send packets which are each ACKed by the keyboard, with up to "window" of them
+    # sent but not yet ACKed. The number in flight starts at 2 and goes up by one
+    # after each run of that many ACKs. ACKs can only be counted, not matched up
+    # with packets, so nothing is ever sent again: returns False as soon as the
+    # keyboard says it's busy (it may have thrown a packet away), nothing is ACKed
+    # for RETRANSMIT_TIMEOUT, or there are more ACKs than packets. Otherwise returns
+    # True once every packet has been ACKed.
+    acked = 0       # Number of packets ACKed
+    sent = 0        # Number of packets sent
+    n = min(2, window)
+    clean = 0       # ACKs since the window last changed
+    self.acks_rxed = 0
+    self.busy_rxed = 0
+    last_progress = time.monotonic()
+    while acked < len(pkts):
+      while sent < len(pkts) and sent - acked < n:
+        os.write(self.f, pkts[sent])
+        sent += 1
+
+      remaining = last_progress + RETRANSMIT_TIMEOUT - time.monotonic()
+      if remaining <= 0:
+        return False
+      if self._poll.poll(remaining*1000.0):
+        self.read_response()
+
+      if self.busy_rxed > 0:
+        return False
+      if self.acks_rxed > 0:
+        acked += self.acks_rxed
+        clean += self.acks_rxed
+        self.acks_rxed = 0
+        if acked > sent:
+          return False
+        last_progress = time.monotonic()
+        if clean >= n and n < window:
+          n += 1
+          clean = 0
+    return True
+
+  def upload_ac7(self, param_set, data, memory=1, category=30, *, window=1, chunk_size=CHUNK_SIZE, _debug=False):
+
+    f = self.f
+
+    # Flush the input queue
+    self.read_response()
+    time.sleep(0.4)
+
+
+    probing = chunk_size == 0
+    pkts = None
+    for attempt in range(UPLOAD_RETRIES + 1):
+      if attempt > 0:
+        # The keyboard may or may not have taken the packets that weren't ACKed.
+        # End the bulk transfer without an ESS, and start again from the beginning
+        # one packet at a time
+        self.drain()
+        os.write(f, make_packet(parameter_set=param_set, category=category, memory=memory, command=0xe))
+        window = 1
+        if chunk_size != CHUNK_SIZE:
+          # Larger packets may be what went wrong, so go back to the usual size
+          if probing:
+            self.forget_chunk_size(category, memory)
+          chunk_size = CHUNK_SIZE
+          pkts = None
+
+      # Send the SBS command
+      pkt = make_packet(command = 8, sub_command = 3)
+      #print(pkt)
+      os.write(f, pkt)  # SBS(HBS)
+      self.wait_for_ack()
+
+      done = 0
+      if chunk_size == 0 and len(data) > 0:
+        # Find the largest size the keyboard takes, sending the first packet with it
+        size = self.probe_chunk_size(param_set, data, category, memory)
+        if size is None:
+          continue
+        chunk_size = size
+        done = 1
+
+      if pkts is None:
+        pkts = []
+        i = 0
+        while i < len(data):
+          # Make a HBS packet:
+          # Category 30 = Rhythms
+          # Parameter set: indicates the specific rhythm
+          # Memory 1 = user rhythm space
+          
+          len_remaining = len(data) - i
+          if len_remaining > chunk_size:
+            len_remaining = chunk_size 
+          
+          
+          pkts.append(make_packet(parameter_set=param_set, category=category, memory=memory, command=5, length=len_remaining, data = data[i:i+len_remaining]))
+          i += len_remaining
+
+      if window > 1:
+        ok = self.send_pipelined(pkts[done:], window)
+      else:
+        ok = self.send_acked(pkts[done:])
+      if ok:
+        break
+    else:
+      self._abort()
+      # Timed out. Completely exit the program
+      raise SysexTimeoutError("SYSEX communication timed out. Exiting ...")
 
 
-  # Send ESS (no ACK expected)
-  #print("Sending ESS")
-  os.write(f, make_packet(parameter_set=param_set, category=category, memory=memory, command=0xd))
-  time.sleep(0.3)
 
-  # Send EBS (no ACK expected)
-  #print("Sending EBS")
-  os.write(f, make_packet(parameter_set=param_set, category=category, memory=memory, command=0xe))
-  time.sleep(0.3)
+    # Send ESS (no ACK expected)
+    #print("Sending ESS")
+    os.write(f, make_packet(parameter_set=param_set, category=category, memory=memory, command=0xd))
+    time.sleep(0.3)
 
-  if fs is None:
-    os.close(f)
+    # Send EBS (no ACK expected)
+    #print("Sending EBS")
+    os.write(f, make_packet(parameter_set=param_set, category=category, memory=memory, command=0xe))
+    time.sleep(0.3)
 
+  def download_ac7(self, param_set, memory=1, category=30, *, _debug=False):
 
+    f = self.f
 
+    # Flush the input queue
+    self.read_response()
+    time.sleep(0.4)
 
 
+    self.rx_decoder = Midi7BitDecoder()
 
 
-def download_ac7_internal(param_set, memory=1, category=30, *, fd=None, fs=None, _debug=False):
+    # Send the SBS command
 
-  global have_got_ess
-  global total_rxed
+    pkt = make_packet(command = 8, sub_command = 2)
+    #print(pkt)
+    os.write(f, pkt)  # SBS(HBR)
+    self.wait_for_ack()
 
-  if fd is None:
-    fd = DEVICE_NAME
 
-  # Open the device (if needed)
-  if fs is None:
-    f = os.open(fd, os.O_RDWR)
-  else:
-    f = fs
+    pkt = make_packet(command = 4, parameter_set=param_set, category=category, memory=memory)
+    #print(pkt)
+    os.write(f, pkt)  # HBR
 
 
-  # Flush the input queue
-  parse_response(os.read(f, 20))
-  time.sleep(0.4)
+    self.have_got_ess = False
 
 
-  total_rxed = b''
+    while True:
 
 
-  # Send the SBS command
+      self.wait_for_ack()
+      
+      if self.have_got_ess:
+        break
+      
+      
+      pkt = make_packet(parameter_set=param_set, category=category, memory=memory, command=0xa)
+      os.write(f, pkt)
 
-  pkt = make_packet(command = 8, sub_command = 2)
-  #print(pkt)
-  os.write(f, pkt)  # SBS(HBR)
-  wait_for_ack(f)
 
 
-  pkt = make_packet(command = 4, parameter_set=param_set, category=category, memory=memory)
-  #print(pkt)
-  os.write(f, pkt)  # HBR
+    # Send EBS (no ACK expected)
+    os.write(f, make_packet(parameter_set=param_set, category=category, memory=memory, command=0xe))
+    time.sleep(0.3)
+    
+    return bytes(self.rx_decoder.sink)
 
 
-  have_got_ess = False
 
+# The functions below each use a new SysexSession for the one call
 
-  while True:
+def set_single_parameter(parameter, data, category=3, memory=3, parameter_set=0, block0=0, block1=0, *, fd=None, fs=None, _debug=False):
+  with SysexSession(fd, fs) as s:
+    s.set_single_parameter(parameter, data, category, memory, parameter_set, block0, block1, _debug=_debug)
 
 
-    wait_for_ack(f)
-    
-    if have_got_ess:
-      break
-    
-    
-    pkt = make_packet(parameter_set=param_set, category=category, memory=memory, command=0xa)
-    os.write(f, pkt)
+def get_single_parameter(parameter, category=3, memory=3, parameter_set=0, block0=0, block1=0, length=0, *, fd=None, fs=None, _debug=False):
+  with SysexSession(fd, fs) as s:
+    return s.get_single_parameter(parameter, category, memory, parameter_set, block0, block1, length, _debug=_debug)
 
 
+def upload_ac7_internal(param_set, data, memory=1, category=30, *, window=1, chunk_size=CHUNK_SIZE, fd=None, fs=None, _debug=False):
+  with SysexSession(fd, fs) as s:
+    s.upload_ac7(param_set, data, memory, category, window=window, chunk_size=chunk_size, _debug=_debug)
 
-  # Send EBS (no ACK expected)
-  os.write(f, make_packet(parameter_set=param_set, category=category, memory=memory, command=0xe))
-  time.sleep(0.3)
 
-  if fs is None:
-    os.close(f)
-  
-  return total_rxed
+def download_ac7_internal(param_set, memory=1, category=30, *, fd=None, fs=None, _debug=False):
+  with SysexSession(fd, fs) as s:
+    return s.download_ac7(param_set, memory, category, _debug=_debug)
 
 
 if __name__=="__main__":
@@ -21,8 +21,8 @@ __version__ = "0.0.0"
 #
 ## Functions:
 #
-#   upload_ac7(dest_num, data, *, fd=None)
-#   ======================================
+#   upload_ac7(dest_num, data, *, window=1, chunk_size=CHUNK_SIZE, fd=None)
+#   =======================================================================
 #
 # Uploads an AC7 rhythm to the keyboard. Parameters:
 #
@@ -32,6 +32,15 @@ __version__ = "0.0.0"
 #               format, which is identical to the format of an .AC7 file
 #               as saved by the keyboard. It should be possible to just
 #               read an .AC7 file and upload it with no modification.
+#   window:    <Optional> most packets to send before the keyboard has
+#               acknowledged them. Default is 1, i.e. wait for each packet to
+#               be acknowledged before sending the next. Larger values can be
+#               quicker; the upload starts again one packet at a time if the
+#               keyboard can't keep up.
+#   chunk_size: <Optional> bytes of data in each packet. Default is
+#               CHUNK_SIZE (0x80), which every keyboard accepts. 0 means
+#               probe: find the largest size the keyboard accepts on the
+#               first upload, and remember it for later uploads.
 #   fd:        <Optional> the device filename to use. If not specified,
 #               a default of "/dev/midi1" will be used.
 #
@@ -64,17 +73,19 @@ __version__ = "0.0.0"
 #      f.write(download_ac7(294))
 #
 
+import argparse
 import sys
 
 from internal.sysex_comms_internal import download_ac7_internal
 from internal.sysex_comms_internal import upload_ac7_internal
+from internal.sysex_comms_internal import CHUNK_SIZE
 
 
-def upload_ac7(dest_num, data, *, fd=None):
+def upload_ac7(dest_num, data, *, window=1, chunk_size=CHUNK_SIZE, fd=None):
 
   if dest_num >= 294 and dest_num <= 343:
     # Uploading to user memory area
-    upload_ac7_internal(dest_num - 294, data, fd=fd)
+    upload_ac7_internal(dest_num - 294, data, window=window, chunk_size=chunk_size, fd=fd)
   else:
     # Cannot do bulk uploads to preset locations
     raise Exception("Wrong destination number: cannot do bulk uploads to preset location")
@@ -95,13 +106,18 @@ def download_ac7(src_num, *, fd=None):
 if __name__=="__main__":
   if sys.version_info[0] < 3:
     raise Exception("Only for use with Python 3! (Found {0}.{1})".format(sys.version_info[0], sys.version_info[1]))
-  if len(sys.argv) >= 2:
+  parser = argparse.ArgumentParser(description="Upload an AC7 rhythm from the standard input to a Casio keyboard, or download one to the standard output if nothing is piped in.")
+  parser.add_argument("number", type=int, nargs="?", help="rhythm number, 294-343")
+  parser.add_argument("-w", "--window", type=int, default=1, help="most packets to send before they've been acknowledged (upload only). Default is 1")
+  parser.add_argument("-c", "--chunk-size", type=int, default=CHUNK_SIZE, help="bytes of data in each packet (upload only), or 0 to find the largest the keyboard accepts. Default is {0}".format(CHUNK_SIZE))
+  args = parser.parse_args()
+  if args.number is not None:
     if not sys.stdin.isatty():
       # sysin has some data being piped in. Assume we are to do an upload
-      dest_num = int(sys.argv[1])
+      dest_num = args.number
       sys.stdout.write("Uploading to rhythm number {0}\n".format(dest_num))
-      upload_ac7(dest_num, sys.stdin.buffer.read())
+      upload_ac7(dest_num, sys.stdin.buffer.read(), window=args.window, chunk_size=args.chunk_size)
     else:
       # sysin is not a pipe. Assume we are to do a download
-      dest_num = int(sys.argv[1])
+      dest_num = args.number
       sys.stdout.buffer.write(download_ac7(dest_num))